@@ -0,0 +1,84 @@
+import array
+import operator
+from itertools import accumulate
+from datetime import date, datetime
+
+# Packed per-day counts: unsigned 32-bit, one entry per UTC day
+TYPECODE = "I"
+
+# Day numbers are date.toordinal() values; 0001-01-01 (ordinal 1) was a Monday
+def weekday_of(day):
+    return (day - 1) % 7
+
+# Pack {day: count} dictionaries into dense arrays running from the first to
+# the last active day. Returns (first_day, changesets_bytes, changes_bytes),
+# or None if there are no days.
+def pack(day_changesets, day_changes):
+    days = set(day_changesets or ()) | set(day_changes or ())
+    if not days:
+        return None
+    first_day = min(days)
+    length = max(days) - first_day + 1
+    changesets = array.array(TYPECODE, bytes(length * array.array(TYPECODE).itemsize))
+    changes = array.array(TYPECODE, changesets)
+    for day, count in (day_changesets or {}).items():
+        changesets[day - first_day] = count
+    for day, count in (day_changes or {}).items():
+        changes[day - first_day] = count
+    return first_day, changesets.tobytes(), changes.tobytes()
+
+# Windows up to this many days are summed directly; longer ones use prefix sums
+SCAN_LIMIT = 400
+
+# A user's per-day activity, answering window queries.
+# Short windows (like the app's 30 days) are summed straight from the arrays.
+# Longer ones use cumulative arrays, built on the first long query and kept
+# with the series, so each figure then costs two lookups.
+class DaySeries:
+    def __init__(self, first_day, changesets_bytes, changes_bytes):
+        self.first_day = first_day
+        # Views, not copies: the bytes can come straight from a memory-mapped snapshot
+        self.changesets = memoryview(changesets_bytes).cast(TYPECODE)
+        self.changes = memoryview(changes_bytes).cast(TYPECODE)
+        self.totals = None  # (changesets, changes, active days) prefix sums; index i covers days [0, i)
+
+    def _active(self, lo, hi):
+        return map(bool, map(operator.or_, self.changesets[lo:hi], self.changes[lo:hi]))
+
+    def _prefix_sums(self):
+        if self.totals is None:
+            self.totals = tuple(array.array("Q", accumulate(values, initial=0))
+                                for values in (self.changesets, self.changes, self._active(0, len(self.changes))))
+        return self.totals
+
+    def _sums(self, lo, hi):
+        if hi - lo <= SCAN_LIMIT:
+            return sum(self.changesets[lo:hi]), sum(self.changes[lo:hi]), sum(self._active(lo, hi))
+        return tuple(totals[hi] - totals[lo] for totals in self._prefix_sums())
+
+    @property
+    def last_day(self):
+        return self.first_day + len(self.changesets) - 1
+
+    # Activity between two day numbers, both included
+    def window(self, start, end):
+        lo = min(max(start - self.first_day, 0), len(self.changesets))
+        hi = min(max(end - self.first_day + 1, lo), len(self.changesets))
+        changesets, changes, active_days = self._sums(lo, hi)
+        weekday_edits = [0] * 7
+        for offset in range(min(7, hi - lo)):
+            weekday_edits[weekday_of(self.first_day + lo + offset)] = sum(self.changesets[lo + offset:hi:7])
+        return {
+            "start": date.fromordinal(start),
+            "end": date.fromordinal(end),
+            "changesets": changesets,
+            "changes": changes,
+            "active_days": active_days,
+            "weekday_edits": weekday_edits,
+        }
+
+    # Activity over the last `days` days, today included, counted like the
+    # crawler's 30-day figures (see stats.RECENT_DAYS)
+    def last_days(self, days, today=None):
+        today = (today or datetime.utcnow().date()).toordinal()
+        return self.window(today - days + 1, today)
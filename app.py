@@ -1,24 +1,201 @@
-from flask import Flask, render_template, request
 import os
-import pandas as pd
-import ast  # Importing ast to convert string representation of lists into actual lists
+import gzip
+import calendar
+import time
+from datetime import date, datetime
+from flask import Flask, Response, render_template, request, g, jsonify
+import store
+import stats
+import metrics
+from cache import RecordCache
+from snapshot import SnapshotReader
+import livefetch
 
 app = Flask(__name__)
 
-DATA_FOLDER = "data"
-
-# Function to find the correct CSV file by username
-def find_file_by_username(username):
-    for file in os.listdir(DATA_FOLDER):
-        if file.endswith(".csv"):
-            file_path = os.path.join(DATA_FOLDER, file)
-            try:
-                df = pd.read_csv(file_path)
-                if "Username" in df.columns and df["Username"][0].strip().lower() == username.strip().lower():
-                    return file_path  # Found matching username
-            except Exception as e:
-                print(f"Error reading {file}: {e}")
-    return None  # No match found
+# Number of decoded user records kept in memory
+RECORD_CACHE_SIZE = int(os.environ.get("RECORD_CACHE_SIZE", 1024))
+
+# Windows (in days) returned by the activity endpoint when none are asked for
+DEFAULT_ACTIVITY_WINDOWS = [7, 30, 365]
+
+# Most usernames a single suggestion request can return
+MAX_SUGGESTIONS = 20
+
+# Most users a single leaderboard request can return
+MAX_LEADERBOARD_SIZE = 100
+
+# Most users a single batch lookup or comparison can ask for
+MAX_BATCH_USERS = 500
+
+# Stats added up across the users of a comparison (the histograms are added up too)
+COMPARE_TOTALS = ["total_edit_days", "active_edit_days_30", "total_changes", "last_30_days_changes",
+                  "changeset_count", "changesets_with_comments"]
+
+# API responses smaller than this (bytes) are sent uncompressed
+GZIP_MIN_SIZE = 256
+
+# Time spent in each part of a request: finding the user ID, loading the
+# record, fetching it live from the API, and rendering the response
+PHASE_SECONDS = {phase: metrics.histogram("app_phase_seconds", "Time per request phase", phase=phase)
+                 for phase in ("lookup", "load", "fetch", "render")}
+
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+@app.after_request
+def record_timing(response):
+    endpoint = request.endpoint or "not_found"
+    metrics.histogram("app_request_seconds", "Time per request by endpoint",
+                      endpoint=endpoint).observe(time.perf_counter() - g.started)
+    return response
+
+# Create or upgrade the database once at startup; requests only read from it
+store.connect().close()
+
+# One database connection per request (sqlite connections can't be shared between threads)
+def get_db():
+    if "db" not in g:
+        g.db = store.connect_reader()
+    return g.db
+
+@app.teardown_appcontext
+def close_db(exception):
+    db = g.pop("db", None)
+    if db is not None:
+        db.close()
+
+# Recently shown user records (see cache.py)
+RECORD_CACHE = RecordCache(RECORD_CACHE_SIZE)
+
+# Users missing from the store are fetched live from the API (see livefetch.py)
+LIVE_FETCH = os.environ.get("LIVE_FETCH", "1") != "0"
+LIVE_FETCHER = livefetch.LiveFetcher() if LIVE_FETCH else None
+
+metrics.gauge("app_record_cache_size", "User records in the cache", function=lambda: len(RECORD_CACHE.records))
+metrics.gauge("app_record_cache_hit_rate", "Share of record lookups served from the cache",
+              function=lambda: RECORD_CACHE.stats()["hit_rate"])
+if LIVE_FETCHER is not None:
+    metrics.gauge("app_live_fetches_in_flight", "Users being fetched from the API",
+                  function=lambda: len(LIVE_FETCHER.in_flight))
+
+# Snapshot published by the crawler, shared by all workers (see snapshot.py)
+SNAPSHOTS = SnapshotReader()
+
+# Function to find the user ID for a username: from the snapshot, or through
+# the database's username index for users newer than it (or without one)
+def find_user_id_by_username(username):
+    db = get_db()
+    user_id = SNAPSHOTS.find_username(db, username)
+    return user_id if user_id is not None else store.find_user_ids(db, [username])[username]
+
+# Load a user's record along with their per-day activity (under "Activity")
+def _load_record(db, user_id):
+    record = store.load_user(db, user_id)
+    if record is not None:
+        record["Activity"] = store.load_activity(db, user_id)
+    return record
+
+# Function to load a user's record, from the snapshot when it has an up to
+# date copy, otherwise from the cache or the database
+def load_user_record(user_id):
+    db = get_db()
+    record = SNAPSHOTS.load_user(db, user_id)
+    if record is None:
+        RECORD_CACHE.sync(db)
+        record = RECORD_CACHE.get(user_id, lambda user_id: _load_record(db, user_id))
+    return with_current_30_days(record)
+
+# The 30-day figures are recomputed from the per-day activity, so they stay
+# current between crawls
+def with_current_30_days(record):
+    if record is None or record["Activity"] is None:
+        return record
+    last_30_days = record["Activity"].last_days(stats.RECENT_DAYS)
+    return dict(record, **{
+        "Active Edit Days (Last 30 Days)": last_30_days["active_days"],
+        "Changes (Last 30 Days)": last_30_days["changes"],
+    })
+
+# Find a user's record from a user ID or username typed by a visitor.
+# Returns (user_id, record); record is None if the user has no data.
+def find_user_record(user_input):
+    with PHASE_SECONDS["lookup"].time():
+        if user_input.isdecimal():  # If input is a numeric User ID (exactly what int() accepts)
+            user_id = int(user_input)
+        else:  # If input is a Username
+            user_id = find_user_id_by_username(user_input)
+
+    user_data = None
+    if user_id is not None:
+        with PHASE_SECONDS["load"].time():
+            user_data = load_user_record(user_id)
+
+    if LIVE_FETCHER is not None:
+        if user_data is None:
+            # Unknown user: fetch them now (concurrent searches share one fetch)
+            with PHASE_SECONDS["fetch"].time():
+                user_id = LIVE_FETCHER.fetch(user_id if user_id is not None else user_input)
+                if user_id is not None:
+                    user_data = load_user_record(user_id)
+        elif time.time() - (user_data["Updated At"] or 0) > livefetch.STALE_AFTER:
+            LIVE_FETCHER.refresh(user_id)  # Serve what we have, refresh in the background
+
+    return user_id, user_data
+
+# Find the records of many users (IDs or usernames) at once: one snapshot
+# check, then one username index query and one bulk read for what the
+# snapshot doesn't have. The record cache is left alone so a big team page
+# doesn't flush it, and unknown users are reported rather than fetched live.
+# Returns (records in input order without repeats, inputs with no data).
+def find_user_records(user_inputs):
+    db = get_db()
+    with PHASE_SECONDS["lookup"].time():
+        usernames = [text for text in user_inputs if not text.isdecimal()]
+        found = SNAPSHOTS.find_usernames(db, usernames)
+        found.update(store.find_user_ids(db, [username for username in usernames if username not in found]))
+        user_ids = {text: int(text) if text.isdecimal() else found[text] for text in user_inputs}
+
+    with PHASE_SECONDS["load"].time():
+        wanted = list(dict.fromkeys(user_id for user_id in user_ids.values() if user_id is not None))
+        records = SNAPSHOTS.load_users(db, wanted)
+        records.update(store.load_users(db, [user_id for user_id in wanted if user_id not in records]))
+
+    found_records = [with_current_30_days(records[user_id]) for user_id in wanted if user_id in records]
+    not_found = [text for text in user_inputs if user_ids.get(text) not in records]
+    return found_records, not_found
+
+# Split a list of user IDs / usernames, each entry possibly holding several
+# separated by commas or new lines; blanks and repeats are dropped
+def parse_user_list(values):
+    inputs = []
+    for value in values:
+        inputs.extend(part.strip() for part in value.replace("\n", ",").split(","))
+    return list(dict.fromkeys(part for part in inputs if part))
+
+# Totals across compared users (records in the API's JSON shape)
+def compare_totals(users):
+    totals = {key: sum(user[key] or 0 for user in users) for key in COMPARE_TOTALS}
+    for key, size in store.HISTOGRAM_SIZES.items():
+        totals[key] = [sum(user[key][slot] for user in users) for slot in range(size)]
+    first_edits = [str(user["first_edit"]) for user in users if user["first_edit"]]
+    last_edits = [str(user["last_edit"]) for user in users if user["last_edit"]]
+    totals["first_edit"] = min(first_edits) if first_edits else None
+    totals["last_edit"] = max(last_edits) if last_edits else None
+    totals["users"] = len(users)
+    return totals
+
+# Look up and compare a list of users; returns (comparison, error)
+def compare_users(user_inputs):
+    if not user_inputs:
+        return None, "Enter at least one user ID or username."
+    if len(user_inputs) > MAX_BATCH_USERS:
+        return None, f"Compare at most {MAX_BATCH_USERS} users at a time."
+    records, not_found = find_user_records(user_inputs)
+    with PHASE_SECONDS["render"].time():
+        users = [record_to_json(record) for record in records]
+        return {"users": users, "totals": compare_totals(users), "not_found": not_found}, None
 
 @app.route("/", methods=["GET", "POST"])
 def index():
@@ -26,28 +203,154 @@ def index():
     error = None
 
     if request.method == "POST":
-        user_input = request.form.get("user_id").strip()
+        _, user_data = find_user_record(request.form.get("user_id").strip())
 
-        if user_input.isdigit():  # If input is a numeric User ID
-            file_path = os.path.join(DATA_FOLDER, f"{user_input}.csv")
-        else:  # If input is a Username
-            file_path = find_file_by_username(user_input)
+        if user_data is None:
+            error = "User not found or has no data."
+
+    with PHASE_SECONDS["render"].time():
+        return render_template("index.html", user_data=user_data, error=error)
+
+# Side-by-side view of several users, e.g. a team page
+@app.route("/compare", methods=["GET", "POST"])
+def compare():
+    comparison = None
+    error = None
+    users_text = request.values.get("users", "")
+
+    if users_text.strip():
+        comparison, error = compare_users(parse_user_list([users_text]))
+        if comparison is not None and not comparison["users"]:
+            comparison, error = None, "None of these users were found or have data."
 
-        if file_path and os.path.exists(file_path):
-            user_data = pd.read_csv(file_path).to_dict(orient="records")[0]
+    with PHASE_SECONDS["render"].time():
+        return render_template("index.html", comparison=comparison, users_text=users_text, error=error)
 
-            # ? Convert stringified lists back into actual Python lists/dictionaries
-            for key in ["Edits Per Weekday", "Edits Per Hour"]:
-                if key in user_data and isinstance(user_data[key], str):
-                    try:
-                        user_data[key] = ast.literal_eval(user_data[key])  # Convert string to list/dict
-                    except (SyntaxError, ValueError):
-                        user_data[key] = {}  # Default to an empty dictionary if parsing fails
+# Convert a template record into the API's JSON shape (stat key names, histograms as arrays)
+def record_to_json(record):
+    data = {key: record[label] for key, label in store.FIELDS}
+    for key, size in store.HISTOGRAM_SIZES.items():
+        data[key] = [data[key].get(slot, 0) for slot in range(size)]
+    return data
 
+# Compress a response body when the client accepts gzip
+def gzip_response(response):
+    response.vary.add("Accept-Encoding")
+    if response.status_code != 200 or "gzip" not in request.accept_encodings:
+        return response
+    body = response.get_data()
+    if len(body) < GZIP_MIN_SIZE:
+        return response
+    response.set_data(gzip.compress(body, compresslevel=6))
+    response.headers["Content-Encoding"] = "gzip"
+    return response
+
+# A user's stats as JSON.
+# The ETag changes whenever the record is rewritten, so clients polling with
+# If-None-Match get an empty 304 until the crawler saves new stats.
+@app.route("/api/users/<user>")
+def api_user(user):
+    _, user_data = find_user_record(user.strip())
+    if user_data is None:
+        return jsonify(error="User not found or has no data."), 404
+
+    with PHASE_SECONDS["render"].time():
+        response = jsonify(record_to_json(user_data))
+    # Strong ETags name one exact byte sequence, so the gzipped body gets its own
+    compressed = "gzip" in request.accept_encodings and len(response.get_data()) >= GZIP_MIN_SIZE
+    etag = f"{user_data['User ID']}-{user_data['Version']}"
+    last_modified = user_data["Updated At"]
+    if user_data["Activity"] is not None:
+        # The 30-day figures move on at midnight (UTC) even when the record doesn't
+        today = datetime.utcnow().date()
+        etag += f"-{today.toordinal()}"
+        last_modified = max(last_modified or 0, calendar.timegm(today.timetuple()))
+    response.set_etag(etag + ("-gzip" if compressed else ""))
+    if last_modified:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True  # Cacheable, but revalidated on every use
+    response.make_conditional(request)
+    return gzip_response(response)
+
+# Several users' stats and their totals in one request, for team pages.
+# Takes up to MAX_BATCH_USERS IDs or usernames: GET /api/users?users=12,alice,34
+# or POST {"users": [12, "alice", 34]}.
+@app.route("/api/users", methods=["GET", "POST"])
+def api_users():
+    if request.method == "POST":
+        body = request.get_json(silent=True)
+        values = body.get("users") if isinstance(body, dict) else None
+        if not isinstance(values, list):
+            return jsonify(error='Send a JSON object like {"users": [12, "alice"]}.'), 400
+        user_inputs = list(dict.fromkeys(str(value).strip() for value in values if str(value).strip()))
+    else:
+        user_inputs = parse_user_list(request.args.getlist("users"))
+
+    comparison, error = compare_users(user_inputs)
+    if error is not None:
+        return jsonify(error=error), 400
+    return gzip_response(jsonify(comparison))
+
+# A user's activity over one or more windows ending today, e.g. ?days=7&days=365,
+# or over a date range, e.g. ?start=2024-01-01&end=2024-12-31
+@app.route("/api/users/<user>/activity")
+def api_user_activity(user):
+    user_id, user_data = find_user_record(user.strip())
+    if user_data is None or user_data["Activity"] is None:
+        return jsonify(error="User not found or has no activity data."), 404
+    series = user_data["Activity"]
+
+    try:
+        if "start" in request.args or "end" in request.args:
+            start = date.fromisoformat(request.args.get("start", date.fromordinal(series.first_day).isoformat()))
+            end = date.fromisoformat(request.args.get("end", datetime.utcnow().date().isoformat()))
+            windows = [series.window(start.toordinal(), end.toordinal())]
         else:
-            error = "User not found or has no data."
+            days = request.args.getlist("days", type=int) or DEFAULT_ACTIVITY_WINDOWS
+            windows = [dict(series.last_days(n), days=n) for n in days if n > 0]
+    except (ValueError, OverflowError):
+        return jsonify(error="Give windows as a number of days or as YYYY-MM-DD dates."), 400
+
+    for window in windows:
+        window["start"] = window["start"].isoformat()
+        window["end"] = window["end"].isoformat()
+    return jsonify(user_id=user_id, first_day=date.fromordinal(series.first_day).isoformat(),
+                   last_day=date.fromordinal(series.last_day).isoformat(), windows=windows)
+
+# Usernames starting with the typed text, for the search box, e.g. /api/suggest?q=ab
+@app.route("/api/suggest")
+def api_suggest():
+    limit = max(min(request.args.get("limit", 10, type=int), MAX_SUGGESTIONS), 0)
+    db = get_db()
+    prefix = request.args.get("q", "")
+    matches = SNAPSHOTS.suggest(db, prefix, limit)
+    if matches is None:  # No snapshot published yet
+        matches = store.suggest_usernames(db, prefix, limit)
+    return jsonify([{"username": username, "user_id": user_id} for username, user_id in matches])
+
+# Top users by one of store.LEADERBOARD_METRICS, e.g. /api/leaderboard/total_changes?limit=10
+@app.route("/api/leaderboard/<metric>")
+def api_leaderboard(metric):
+    if metric not in store.LEADERBOARD_METRICS:
+        return jsonify(error=f"Unknown metric, use one of: {', '.join(store.LEADERBOARD_METRICS)}"), 404
+    limit = min(request.args.get("limit", 10, type=int), MAX_LEADERBOARD_SIZE)
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    rows = store.top_users(get_db(), metric, max(limit, 0), offset)
+    return jsonify([{"rank": offset + rank, "user_id": user_id, "username": username, metric: value}
+                    for rank, (user_id, username, value) in enumerate(rows, start=1)])
+
+# Prometheus scrape endpoint
+@app.route("/metrics")
+def metrics_page():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
-    return render_template("index.html", user_data=user_data, error=error)
+# Cache hit/miss counters, used to size RECORD_CACHE_SIZE
+@app.route("/api/cache")
+def cache_stats():
+    counters = RECORD_CACHE.stats()
+    if LIVE_FETCHER is not None:
+        counters["live_fetch"] = LIVE_FETCHER.stats()
+    return jsonify(counters)
 
 if __name__ == "__main__":
     app.run(debug=True, host="0.0.0.0", port=8001)
@@ -0,0 +1,94 @@
+import os
+import time
+import zlib
+import sqlite3
+import hashlib
+import threading
+from urllib.parse import urlsplit, parse_qs
+import store
+
+# Folder holding the raw response archive
+ARCHIVE_FOLDER = os.path.join(store.DATA_FOLDER, "archive")
+
+# zlib level for archived responses (changeset XML shrinks about tenfold)
+COMPRESSION_LEVEL = 6
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    url TEXT NOT NULL,
+    user_id INTEGER,
+    window_start TEXT,
+    window_end TEXT,
+    digest TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (url, digest)
+);
+CREATE INDEX IF NOT EXISTS responses_user ON responses (user_id, fetched_at);
+"""
+
+# Archive of raw changeset responses.
+# Bodies are stored once per content hash (compressed, under objects/), so
+# repeated identical pages such as empty results take no extra space. An
+# index database maps each request (its URL, user ID and time window) to
+# the bodies it returned, which is enough to rebuild every user's stats
+# offline (see grab.py --replay).
+class ResponseArchive:
+    def __init__(self, folder=ARCHIVE_FOLDER):
+        self.folder = folder
+        os.makedirs(os.path.join(folder, "objects"), exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(folder, "index.db"), timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.lock = threading.Lock()  # put() runs on worker threads
+
+    def object_path(self, digest):
+        return object_path(self.folder, digest)
+
+    # Store one response body; blocking, so the crawler calls it off the event loop
+    def put(self, url, body):
+        digest = hashlib.sha256(body).hexdigest()
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(temp_path, "wb") as file:
+                file.write(zlib.compress(body, COMPRESSION_LEVEL))
+            os.replace(temp_path, path)
+        user_id, window_start, window_end = describe(url)
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO responses (url, user_id, window_start, window_end, digest,"
+                              " size, fetched_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                              (url, user_id, window_start, window_end, digest, len(body), time.time()))
+        return digest
+
+    # User IDs with archived responses
+    def user_ids(self):
+        with self.lock:
+            return [user_id for (user_id,) in self.conn.execute(
+                "SELECT DISTINCT user_id FROM responses WHERE user_id IS NOT NULL ORDER BY user_id")]
+
+    # A user's archived responses as (digest, fetched_at), oldest fetch first
+    def responses(self, user_id):
+        with self.lock:
+            return self.conn.execute("SELECT digest, fetched_at FROM responses WHERE user_id = ?"
+                                     " ORDER BY fetched_at", (user_id,)).fetchall()
+
+    def close(self):
+        self.conn.close()
+
+def object_path(folder, digest):
+    return os.path.join(folder, "objects", digest[:2], digest + ".xml.z")
+
+# A response body from the archive
+def read_object(folder, digest):
+    with open(object_path(folder, digest), "rb") as file:
+        return zlib.decompress(file.read())
+
+# User ID and time window of a changesets request URL (None for parts it doesn't have)
+def describe(url):
+    query = parse_qs(urlsplit(url).query)
+    user_id = int(query["user"][0]) if "user" in query else None
+    window = query["time"][0].split(",") if "time" in query else [None]
+    return user_id, window[0], window[1] if len(window) > 1 else None
@@ -0,0 +1,64 @@
+import os
+import sys
+import time
+import random
+import argparse
+from datetime import datetime, timedelta
+
+# Run from anywhere: python bench/aggregate.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import stats
+import columnar
+
+EDITORS = ["JOSM/1.5", "iD 2.27.0", "Potlatch 2", "Level0", None]
+SOURCES = ["survey", "imagination", "local knowledge", None]
+
+# Build a synthetic history of n changesets
+def make_changesets(n, seed=1):
+    rng = random.Random(seed)
+    created_at = datetime(2014, 1, 1)
+    changesets = []
+    for changeset_id in range(1, n + 1):
+        created_at += timedelta(seconds=rng.randint(60, 20000))
+        changesets.append(stats.Changeset(
+            changeset_id,
+            created_at.strftime(stats.TIME_FORMAT),
+            rng.randint(0, 800),
+            rng.choice((0, 0, 0, 1, 2)),
+            rng.choice(EDITORS),
+            rng.choice(SOURCES),
+            "BenchUser",
+            1,
+            False,
+        ))
+    return changesets
+
+# Best wall time of func() over a number of repeats
+def best_of(func, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+def fold_stats(changesets):
+    state = stats.new_state(1)
+    stats.fold(state, changesets)
+    return stats.stats_for_store(state)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare per-changeset and NumPy aggregation")
+    parser.add_argument("--changesets", type=int, default=10000)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    changesets = make_changesets(args.changesets)
+    assert fold_stats(changesets) == columnar.compute_stats(1, changesets), "results differ"
+
+    loop_time = best_of(lambda: fold_stats(changesets), args.repeats)
+    numpy_time = best_of(lambda: columnar.compute_stats(1, changesets), args.repeats)
+    print(f"{args.changesets} changesets, best of {args.repeats}")
+    print(f"  per-changeset fold: {loop_time * 1000:8.2f} ms  ({args.changesets / loop_time:,.0f} changesets/s)")
+    print(f"  NumPy columnar:     {numpy_time * 1000:8.2f} ms  ({args.changesets / numpy_time:,.0f} changesets/s)")
+    print(f"  speedup:            {loop_time / numpy_time:8.1f}x")
@@ -0,0 +1,163 @@
+import os
+import sys
+import json
+import time
+import socket
+import random
+import asyncio
+import argparse
+import resource
+import tempfile
+import contextlib
+import subprocess
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor
+
+# Run from anywhere: python bench/crawl.py
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+import mockapi
+
+# End-to-end benchmark against the local mock API (see mockapi.py):
+#  - crawl: users/s and peak RSS for grab.py's crawl of a range of user IDs
+#  - parse: changeset XML parse throughput
+#  - app: p50/p99 latency of ID and username lookups in app.py
+# Everything runs in a temporary folder, so the real data folder is never touched.
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+# Start the mock API in its own process, so its CPU use and memory don't count against the crawler
+def start_mock(args, port):
+    command = [sys.executable, os.path.join(BENCH_DIR, "mockapi.py"), "--port", str(port),
+               "--first-user", str(args.first_user), "--last-user", str(args.first_user + args.users - 1),
+               "--mean-changesets", str(args.mean_changesets), "--empty-rate", str(args.empty_rate),
+               "--page-size", str(args.page_size), "--latency", str(args.latency), "--jitter", str(args.jitter),
+               "--error-rate", str(args.error_rate), "--rate-limit-rate", str(args.rate_limit_rate)]
+    process = subprocess.Popen(command)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("Mock API did not start")
+
+def mock_stats(port):
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/stats") as response:
+        return json.load(response)
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # Linux reports KiB
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+async def crawl(user_ids, processes):
+    import grab
+    import store
+    from ogfapi import ApiClient
+    executor = ProcessPoolExecutor(processes) if processes else None
+    try:
+        async with ApiClient(executor=executor) as client:
+            return await grab.crawl_users(client, store.connect(), user_ids)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+def bench_crawl(args, port, quiet):
+    import store
+    import ogfapi
+    ogfapi.API_URL = f"http://127.0.0.1:{port}/api/0.6"
+    user_ids = list(range(args.first_user, args.first_user + args.users))
+    output = open(os.devnull, "w") if quiet else sys.stdout
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(output):
+        complete, _ = asyncio.run(crawl(user_ids, args.processes))
+    elapsed = time.perf_counter() - started
+
+    conn = store.connect()
+    saved, changesets = conn.execute("SELECT COUNT(*), COALESCE(SUM(changeset_count), 0) FROM users").fetchone()
+    conn.close()
+    served = mock_stats(port)
+    print(f"crawl: {len(user_ids)} user IDs in {elapsed:.2f} s{'' if complete else ' (incomplete)'}")
+    print(f"  {len(user_ids) / elapsed:10.1f} users/s  ({saved} with data)")
+    print(f"  {changesets / elapsed:10.0f} changesets/s")
+    print(f"  {served['requests']:10d} requests  ({served['requests'] / elapsed:.0f}/s,"
+          f" {served['errors']} errors, {served['rate_limited']} rate limited)")
+    print(f"  {peak_rss_mb():10.1f} MB peak RSS (crawler process)")
+
+def bench_parse(args):
+    import ogfapi
+    data = mockapi.MockData(empty_rate=0, mean_changesets=args.page_size, max_changesets=args.page_size)
+    pages = [mockapi.render(mockapi.select_page(data.history(user_id), float("-inf"), float("inf"), args.page_size))
+             for user_id in range(1, 201)]
+    size = sum(len(page) for page in pages)
+    started = time.perf_counter()
+    parsed = sum(len(ogfapi.parse_changesets_bytes(page)) for page in pages)
+    elapsed = time.perf_counter() - started
+    print(f"parse: {parsed} changesets ({size / 1e6:.1f} MB) in {elapsed * 1000:.1f} ms")
+    print(f"  {parsed / elapsed:10.0f} changesets/s")
+    print(f"  {size / 1e6 / elapsed:10.1f} MB/s")
+
+def bench_app(args):
+    os.environ["LIVE_FETCH"] = "0"  # Measure lookups, not the API
+    import app
+    import store
+    conn = store.connect()
+    users = conn.execute("SELECT user_id, username FROM users").fetchall()
+    conn.close()
+    if not users:
+        print("app: no users saved, skipping")
+        return
+    client = app.app.test_client()
+    rng = random.Random(1)
+    lookups = {
+        "form, by ID": lambda user_id, username: client.post("/", data={"user_id": str(user_id)}),
+        "form, by username": lambda user_id, username: client.post("/", data={"user_id": username}),
+        "JSON API, by ID": lambda user_id, username: client.get(f"/api/users/{user_id}"),
+    }
+    print(f"app: {args.lookups} lookups each over {len(users)} users")
+    for name, lookup in lookups.items():
+        timings = []
+        for _ in range(args.lookups):
+            user_id, username = rng.choice(users)
+            started = time.perf_counter()
+            response = lookup(user_id, username)
+            timings.append(time.perf_counter() - started)
+            assert response.status_code == 200, f"{name}: HTTP {response.status_code}"
+        timings.sort()
+        print(f"  {name:18} p50 {percentile(timings, 0.5) * 1000:7.3f} ms"
+              f"   p99 {percentile(timings, 0.99) * 1000:7.3f} ms")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the crawler and app against a local mock API")
+    parser.add_argument("--users", type=int, default=2000, help="Number of user IDs to crawl")
+    parser.add_argument("--first-user", type=int, default=3000)
+    parser.add_argument("--mean-changesets", type=int, default=50)
+    parser.add_argument("--empty-rate", type=float, default=0.5)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--processes", type=int, default=0, help="Crawl in pipeline mode with this many processes")
+    parser.add_argument("--lookups", type=int, default=2000, help="App lookups per kind")
+    parser.add_argument("--verbose", action="store_true", help="Show the crawler's own output")
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix="hdyctogf-bench-"))  # The store lives in ./data
+    port = free_port()
+    mock = start_mock(args, port)
+    try:
+        bench_crawl(args, port, quiet=not args.verbose)
+    finally:
+        mock.terminate()
+        mock.wait()
+    bench_parse(args)
+    bench_app(args)
@@ -0,0 +1,189 @@
+import sys
+import random
+import asyncio
+import argparse
+from bisect import bisect_left
+from datetime import datetime, timezone
+from aiohttp import web
+
+# Local stand-in for the OpenGeofiction changesets API (GET /api/0.6/changesets).
+# Every user ID in the configured range gets a synthetic, deterministic
+# history (seeded by the user ID), served with the same paging rules as the
+# real API: "time=start,end" selects changesets closed after start and
+# created before end, newest first, at most page_size per response. Latency,
+# server errors and 429s can be injected to exercise the client.
+#
+#   python bench/mockapi.py --port 8090
+#   OGF_API_URL=http://127.0.0.1:8090/api/0.6 python grab.py
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+EDITORS = ["JOSM/1.5 (18822 en)", "iD 2.27.0", "Potlatch 2", "Level0 v1.2", None]
+SOURCES = ["survey", "imagination", "local knowledge", "own work", None]
+
+# Histories are spread between these times (seconds since 1970)
+HISTORY_START = datetime(2010, 1, 1, tzinfo=timezone.utc).timestamp()
+HISTORY_END = datetime(2025, 1, 1, tzinfo=timezone.utc).timestamp()
+
+# Longest a synthetic changeset stays open (seconds)
+MAX_OPEN_TIME = 3600
+
+# Changeset IDs are user_id * ID_STRIDE + n, so they are unique across users
+ID_STRIDE = 100000
+
+def _time(seconds):
+    return datetime.fromtimestamp(seconds, timezone.utc).strftime(TIME_FORMAT)
+
+def _parse_time(text):
+    return datetime.strptime(text, TIME_FORMAT).replace(tzinfo=timezone.utc).timestamp()
+
+def username_of(user_id):
+    return f"Mapper{user_id}"
+
+class MockData:
+    def __init__(self, first_user=3000, last_user=30000, mean_changesets=50, max_changesets=5000,
+                 empty_rate=0.5, seed=1):
+        self.first_user = first_user
+        self.last_user = last_user
+        self.mean_changesets = mean_changesets
+        self.max_changesets = min(max_changesets, ID_STRIDE - 1)
+        self.empty_rate = empty_rate
+        self.seed = seed
+        self.histories = {}
+        self.feed = None
+
+    # A user's changesets as (created, closed, id, changes, comments, editor, source) tuples, oldest first
+    def history(self, user_id):
+        history = self.histories.get(user_id)
+        if history is None:
+            history = self.histories[user_id] = self._generate(user_id)
+        return history
+
+    def _generate(self, user_id):
+        rng = random.Random(self.seed * 1000003 + user_id)
+        if rng.random() < self.empty_rate:
+            return []
+        count = min(int(rng.expovariate(1 / self.mean_changesets)) + 1, self.max_changesets)
+        created = rng.uniform(HISTORY_START, HISTORY_END - 86400)
+        step = (HISTORY_END - created) / count
+        history = []
+        for n in range(count):
+            created += rng.uniform(0, step)
+            history.append((
+                int(created),
+                int(created) + rng.randint(1, MAX_OPEN_TIME),
+                user_id * ID_STRIDE + n,
+                rng.randint(0, 800),
+                rng.choice((0, 0, 0, 1, 2)),
+                rng.choice(EDITORS),
+                rng.choice(SOURCES),
+            ))
+        return history
+
+    # Every user's changesets merged in creation order, for the global feed
+    def all_changesets(self):
+        if self.feed is None:
+            self.feed = sorted((created, closed, changeset_id, changes, comments, editor, source)
+                               for user_id in range(self.first_user, self.last_user + 1)
+                               for created, closed, changeset_id, changes, comments, editor, source
+                               in self.history(user_id))
+        return self.feed
+
+# Changesets closed after start and created before end, newest first
+def select_page(history, start, end, page_size):
+    page = []
+    i = bisect_left(history, (end,)) - 1  # Last changeset created before end
+    while i >= 0 and len(page) < page_size:
+        changeset = history[i]
+        if changeset[0] + MAX_OPEN_TIME <= start:
+            break  # Everything older closed before start
+        if changeset[1] > start:
+            page.append(changeset)
+        i -= 1
+    return page
+
+def render(changesets):
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="mockapi">\n']
+    for created, closed, changeset_id, changes, comments, editor, source in changesets:
+        user_id = changeset_id // ID_STRIDE
+        tags = "".join(f'  <tag k="{key}" v="{value}"/>\n'
+                       for key, value in (("created_by", editor), ("source", source)) if value is not None)
+        parts.append(f' <changeset id="{changeset_id}" created_at="{_time(created)}" open="false"'
+                     f' comments_count="{comments}" changes_count="{changes}" closed_at="{_time(closed)}"'
+                     f' user="{username_of(user_id)}" uid="{user_id}">\n{tags} </changeset>\n')
+    parts.append("</osm>\n")
+    return "".join(parts).encode()
+
+def make_app(data, page_size=100, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit_rate=0.0, retry_after=1):
+    rng = random.Random(data.seed)
+    counters = {"requests": 0, "changesets": 0, "errors": 0, "rate_limited": 0, "not_found": 0}
+
+    async def changesets(request):
+        counters["requests"] += 1
+        if latency or jitter:
+            await asyncio.sleep(latency + rng.uniform(0, jitter))
+        roll = rng.random()
+        if roll < error_rate:
+            counters["errors"] += 1
+            return web.Response(status=503, text="Service Unavailable")
+        if roll < error_rate + rate_limit_rate:
+            counters["rate_limited"] += 1
+            return web.Response(status=429, text="Too Many Requests", headers={"Retry-After": str(retry_after)})
+
+        query = request.query
+        if "user" in query or "display_name" in query:
+            if "user" in query:
+                user_id = int(query["user"])
+            else:
+                name = query["display_name"]
+                user_id = int(name[len("Mapper"):]) if name.startswith("Mapper") and name[6:].isdigit() else -1
+            if not data.first_user <= user_id <= data.last_user:
+                counters["not_found"] += 1
+                return web.Response(status=404, text="Object not found")
+            history = data.history(user_id)
+        else:
+            history = data.all_changesets()
+
+        start, end = float("-inf"), float("inf")
+        if "time" in query:
+            bounds = query["time"].split(",")
+            start = _parse_time(bounds[0])
+            if len(bounds) > 1:
+                end = _parse_time(bounds[1])
+        page = select_page(history, start, end, page_size)
+        counters["changesets"] += len(page)
+        return web.Response(body=render(page), content_type="text/xml", charset="utf-8")
+
+    async def stats(request):
+        return web.json_response(counters)
+
+    app = web.Application()
+    app.router.add_get("/api/0.6/changesets", changesets)
+    app.router.add_get("/stats", stats)
+    return app
+
+def add_arguments(parser):
+    parser.add_argument("--first-user", type=int, default=3000)
+    parser.add_argument("--last-user", type=int, default=30000)
+    parser.add_argument("--mean-changesets", type=int, default=50, help="Average history size of non-empty users")
+    parser.add_argument("--max-changesets", type=int, default=5000)
+    parser.add_argument("--empty-rate", type=float, default=0.5, help="Share of user IDs with no changesets")
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds before each response")
+    parser.add_argument("--jitter", type=float, default=0.02, help="Random extra latency (seconds)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with 503")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Share of requests answered with 429")
+    parser.add_argument("--seed", type=int, default=1)
+
+def app_from_args(args):
+    data = MockData(args.first_user, args.last_user, args.mean_changesets, args.max_changesets,
+                    args.empty_rate, args.seed)
+    return make_app(data, args.page_size, args.latency, args.jitter, args.error_rate, args.rate_limit_rate)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock OpenGeofiction changesets API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    add_arguments(parser)
+    args = parser.parse_args()
+    print(f"? Serving {args.host}:{args.port}/api/0.6 (users {args.first_user}-{args.last_user})", file=sys.stderr)
+    web.run_app(app_from_args(args), host=args.host, port=args.port, print=None, access_log=None)
@@ -0,0 +1,63 @@
+import threading
+from collections import OrderedDict
+import store
+
+# Bounded LRU cache of decoded user records.
+# Entries are invalidated through the store's write version: every batch the
+# crawler saves bumps it, and sync() evicts just the users written since then.
+class RecordCache:
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.records = OrderedDict()
+        self.version = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    # Drop entries for users the crawler has rewritten since the last sync
+    def sync(self, conn):
+        version = store.current_version(conn)
+        with self.lock:
+            if self.version is None or version < self.version:  # First use or database replaced
+                self.records.clear()
+            elif version > self.version:
+                rows = conn.execute("SELECT user_id FROM users WHERE version > ?", (self.version,))
+                for (user_id,) in rows:
+                    if self.records.pop(user_id, None) is not None:
+                        self.invalidations += 1
+            self.version = version
+
+    # Return the cached record for a user, loading it with load(user_id) on a miss
+    def get(self, user_id, load):
+        with self.lock:
+            record = self.records.get(user_id)
+            if record is not None:
+                self.records.move_to_end(user_id)
+                self.hits += 1
+                return record
+            self.misses += 1
+
+        record = load(user_id)
+        if record is not None and self.max_size > 0:
+            with self.lock:
+                self.records[user_id] = record
+                self.records.move_to_end(user_id)
+                while len(self.records) > self.max_size:
+                    self.records.popitem(last=False)
+                    self.evictions += 1
+        return record
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.records),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
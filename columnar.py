@@ -0,0 +1,125 @@
+import numpy as np
+from datetime import datetime, date
+import stats
+
+# Days between 0001-01-01 (date.toordinal() == 1) and 1970-01-01
+EPOCH_ORDINAL = 719163
+
+# Length of an API timestamp, "YYYY-MM-DDTHH:MM:SSZ"
+TIMESTAMP_LENGTH = 20
+
+def _digits(chars, start, length):
+    value = chars[:, start].astype(np.int64)
+    for i in range(start + 1, start + length):
+        value = value * 10 + chars[:, i]
+    return value
+
+# Parse API timestamps into seconds since 1970 by slicing fixed offsets
+# out of the raw bytes (no strptime per changeset)
+def parse_timestamps(timestamps):
+    raw = np.array(timestamps, dtype=f"S{TIMESTAMP_LENGTH}")
+    chars = raw.view(np.uint8).reshape(len(raw), TIMESTAMP_LENGTH) - ord("0")
+    year = _digits(chars, 0, 4)
+    month = _digits(chars, 5, 2)
+    day = _digits(chars, 8, 2)
+    seconds = _digits(chars, 11, 2) * 3600 + _digits(chars, 14, 2) * 60 + _digits(chars, 17, 2)
+
+    # Days since 1970-01-01 from a civil date (proleptic Gregorian calendar)
+    year = year - (month <= 2)
+    era = np.floor_divide(year, 400)
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + np.where(month > 2, -3, 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    days = era * 146097 + day_of_era - 719468
+    return days * 86400 + seconds
+
+# Map a column of values to integer codes; None becomes -1
+def _codes(values):
+    categories = {}
+    codes = np.fromiter((-1 if value is None else categories.setdefault(value, len(categories))
+                         for value in values), dtype=np.int64, count=len(values))
+    return codes, list(categories)
+
+def _usage(codes, categories):
+    counts = np.bincount(codes[codes >= 0], minlength=len(categories))
+    return {categories[i]: int(counts[i]) for i in np.flatnonzero(counts)}, counts
+
+def _most_used(counts, categories):
+    if not len(counts) or counts.max() == 0:
+        return "Unknown"
+    best = np.flatnonzero(counts == counts.max())  # argmax, with ties broken like stats._most_used
+    return max(categories[i] for i in best)
+
+# Columnar version of stats.compute_stats for large histories.
+# The changesets are turned into arrays once and every field is computed with
+# vectorised operations; the result (including the saved state) is the same
+# as folding the changesets one by one.
+def compute_stats(user_id, changesets, fetched_until=None, today=None):
+    changesets = list({cs.id: cs for cs in changesets}.values())
+    if not changesets:
+        return None
+    ids = np.fromiter((cs.id for cs in changesets), dtype=np.int64, count=len(changesets))
+    epoch_seconds = parse_timestamps([cs.created_at for cs in changesets])
+    changes = np.fromiter((cs.changes_count for cs in changesets), dtype=np.int64, count=len(changesets))
+    comments = np.fromiter((cs.comments_count for cs in changesets), dtype=np.int64, count=len(changesets))
+    is_open = np.fromiter((bool(cs.open) for cs in changesets), dtype=bool, count=len(changesets))
+    editors, editor_names = _codes([cs.created_by for cs in changesets])
+    sources, source_names = _codes([cs.source for cs in changesets])
+
+    days = epoch_seconds // 86400 + EPOCH_ORDINAL  # Same numbering as date.toordinal()
+    weekdays = (epoch_seconds // 86400 + 3) % 7  # 1970-01-01 was a Thursday; 0 = Monday
+    hours = (epoch_seconds % 86400) // 3600
+
+    # Username from the newest changeset that has one
+    newest_first = np.argsort(ids)[::-1]
+    username = next((changesets[i].user for i in newest_first if changesets[i].user), None)
+
+    # The saved state only holds closed changesets; open ones are kept aside
+    closed = ~is_open
+    state = stats.new_state(user_id)
+    state["username"] = username
+    state["last_changeset_id"] = int(ids.max())
+    state["fetched_until"] = fetched_until
+    unique_days, day_index = np.unique(days[closed], return_inverse=True)
+    day_totals = np.bincount(day_index, weights=changes[closed], minlength=len(unique_days))
+    day_counts = np.bincount(day_index, minlength=len(unique_days))
+    state["day_changes"] = {int(day): int(total) for day, total in zip(unique_days, day_totals)}
+    state["day_changesets"] = {int(day): int(count) for day, count in zip(unique_days, day_counts)}
+    state["editor_usage"], _ = _usage(editors[closed], editor_names)
+    state["source_usage"], _ = _usage(sources[closed], source_names)
+    state["weekday_edits"] = np.bincount(weekdays[closed], minlength=7).tolist()
+    state["hourly_edits"] = np.bincount(hours[closed], minlength=24).tolist()
+    state["total_changes"] = int(changes[closed].sum())
+    state["changeset_count"] = int(closed.sum())
+    state["changesets_with_comments"] = int((comments[closed] > 0).sum())
+    state["open"] = {changesets[i].id: changesets[i] for i in np.flatnonzero(is_open)}
+
+    # The stats cover every changeset, open or not
+    today = today or datetime.utcnow().date()
+    cutoff = today.toordinal() - stats.RECENT_DAYS + 1
+    recent = days >= cutoff
+    edit_days, all_day_index = np.unique(days, return_inverse=True)
+    all_day_totals = np.bincount(all_day_index, weights=changes, minlength=len(edit_days))
+    all_day_counts = np.bincount(all_day_index, minlength=len(edit_days))
+    _, editor_counts = _usage(editors, editor_names)
+    _, source_counts = _usage(sources, source_names)
+    return {
+        "user_id": user_id,
+        "username": username,
+        "first_edit": date.fromordinal(int(edit_days[0])),
+        "last_edit": date.fromordinal(int(edit_days[-1])),
+        "total_edit_days": len(edit_days),
+        "active_edit_days_30": len(np.unique(days[recent])),
+        "total_changes": int(changes.sum()),
+        "last_30_days_changes": int(changes[recent].sum()),
+        "most_used_editor": _most_used(editor_counts, editor_names),
+        "most_used_source": _most_used(source_counts, source_names),
+        "changeset_count": len(changesets),
+        "changesets_with_comments": int((comments > 0).sum()),
+        "weekday_edits": dict(enumerate(np.bincount(weekdays, minlength=7).tolist())),
+        "hourly_edits": dict(enumerate(np.bincount(hours, minlength=24).tolist())),
+        "last_changeset_id": state["last_changeset_id"],
+        "day_changesets": {int(day): int(count) for day, count in zip(edit_days, all_day_counts)},
+        "day_changes": {int(day): int(total) for day, total in zip(edit_days, all_day_totals)},
+        "state": stats.state_to_json(state),
+    }
@@ -0,0 +1,130 @@
+import time
+import signal
+import asyncio
+import inspect
+
+# Default number of workers (and concurrent users in flight)
+WORKERS = 100
+
+# Seconds between progress lines
+REPORT_INTERVAL = 10
+
+# Runs handle(user_id) for a stream of user IDs with a fixed pool of workers.
+# Each worker pulls the next ID from a queue as soon as it finishes the last
+# one, so a slow user only holds up its own slot. A semaphore caps how many
+# handlers run at once (it can be lower than the number of workers).
+# Ctrl-C stops handing out new IDs and lets in-flight users finish; a second
+# Ctrl-C cancels them. on_result(user_id, result, error) is called for every
+# finished user, with error set to the exception if the handler raised; it
+# may be a coroutine function, in which case the worker waits for it.
+# report() may return an extra line to print with each periodic progress line.
+class Scheduler:
+    def __init__(self, handle, workers=WORKERS, concurrency=None, on_result=None, report_interval=REPORT_INTERVAL,
+                 report=None):
+        self.handle = handle
+        self.workers = workers
+        self.limit = asyncio.Semaphore(concurrency or workers)
+        self.on_result = on_result
+        self.report_interval = report_interval
+        self.report = report
+        self.stopping = False
+        self.total = None
+        self.done = 0
+        self.errors = 0
+        self.started = None
+        self.tasks = []
+
+    # Stop taking new work; called on the first Ctrl-C (or by the caller, with its own message)
+    def stop(self, message="? Stopping after in-flight users finish (Ctrl-C again to abort)..."):
+        if self.stopping:
+            for task in self.tasks:
+                task.cancel()
+            return
+        self.stopping = True
+        print(message)
+
+    async def _produce(self, queue, user_ids):
+        for user_id in user_ids:
+            if self.stopping:
+                break
+            await queue.put(user_id)
+        for _ in range(self.workers):
+            await queue.put(None)  # One stop marker per worker
+
+    async def _work(self, queue):
+        while True:
+            user_id = await queue.get()
+            if user_id is None or self.stopping:
+                return
+            error = None
+            try:
+                async with self.limit:
+                    result = await self.handle(user_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors += 1
+                result = None
+                error = e
+                print(f"? Error processing User ID {user_id}: {e!r}")
+            self.done += 1
+            if self.on_result:
+                waiting = self.on_result(user_id, result, error)
+                if inspect.isawaitable(waiting):
+                    await waiting  # e.g. backpressure from the writer stage
+
+    def progress(self):
+        elapsed = time.monotonic() - self.started
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        line = f"? {self.done} users done, {rate:.1f} users/s, {self.errors} errors"
+        if self.total is not None:
+            remaining = max(self.total - self.done, 0)
+            eta = remaining / rate if rate > 0 else float("inf")
+            line += f", {remaining} remaining, ETA {_format_duration(eta)}"
+        return line
+
+    def _print_progress(self):
+        print(self.progress())
+        if self.report:
+            print(self.report())
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            self._print_progress()
+
+    async def run(self, user_ids):
+        try:
+            self.total = len(user_ids)
+        except TypeError:
+            self.total = None  # Plain iterator, no ETA
+        self.started = time.monotonic()
+
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGINT, self.stop)
+        except (NotImplementedError, RuntimeError):
+            pass  # Not supported on this platform, Ctrl-C raises KeyboardInterrupt as usual
+
+        queue = asyncio.Queue(maxsize=self.workers * 2)
+        producer = asyncio.create_task(self._produce(queue, user_ids))
+        reporter = asyncio.create_task(self._report())
+        self.tasks = [asyncio.create_task(self._work(queue)) for _ in range(self.workers)]
+        try:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        finally:
+            producer.cancel()
+            reporter.cancel()
+            try:
+                loop.remove_signal_handler(signal.SIGINT)
+            except (NotImplementedError, RuntimeError):
+                pass
+        print(self.progress())
+        return self.done
+
+def _format_duration(seconds):
+    if seconds == float("inf"):
+        return "unknown"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
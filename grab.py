@@ -1,151 +1,336 @@
 import os
+import time
+import signal
+import socket
 import asyncio
-import aiohttp
-import xml.etree.ElementTree as ET
-import csv
-from datetime import datetime, timedelta
-from collections import defaultdict
-
-# Define storage folder
-DATA_FOLDER = "data"
-os.makedirs(DATA_FOLDER, exist_ok=True)
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+import store
+import stats
+import journal
+import metrics
+import snapshot
+import archive
+import leases
+import ogfapi
+from ogfapi import ApiClient, fetch_changesets, fetch_active_user_ids
+from crawler import Scheduler
+from writer import StatsWriter, RECORDS_WRITTEN, QUEUE_DEPTH
 
 # Define range of user IDs to check
 USER_ID_START = 3000
 USER_ID_END = 30000
 
-# Time range for "last 30 days"
-TODAY = datetime.utcnow()
-LAST_30_DAYS = TODAY - timedelta(days=30)
+# IDs with no changesets are only rechecked after this many days
+EMPTY_RECHECK_DAYS = 30
+
+# User IDs per lease in a sharded crawl (--shard)
+LEASE_SIZE = 500
+
+# Seconds a lease lasts without renewal; a worker renews it every third of that
+LEASE_TTL = 300
+
+# Meta key holding the time up to which all changesets have been processed
+HIGH_WATER_KEY = "delta_high_water"
 
-# Limit concurrent requests to avoid overloading the API
+# Number of users processed at once (HTTP concurrency adapts, see ogfapi.AdaptiveLimit)
 CONCURRENT_REQUESTS = 100
 
-# Fetch changesets for a given user
-async def fetch_changesets(session, user_id):
-    url = f"https://opengeofiction.net/api/0.6/changesets?user={user_id}"
-    try:
-        async with session.get(url, timeout=10) as response:
-            if response.status != 200:
-                return None  # User has no changesets or API issue
-            xml_text = await response.text()
-            return ET.fromstring(xml_text).findall("changeset")
-    except Exception:
-        return None  # Handle request failures
-
-# Process and extract user stats
-async def process_user(session, user_id):
-    changesets = await fetch_changesets(session, user_id)
-    if not changesets:
-        return None  # No edits found
-
-    edit_days = set()
-    total_changes = 0
-    last_30_days_changes = 0
-    active_edit_days_30 = set()
-    editor_usage = defaultdict(int)
-    source_usage = defaultdict(int)
-    weekday_edits = defaultdict(int)
-    hourly_edits = defaultdict(int)
-    changeset_count = 0
-    changesets_with_comments = 0
-    username = None
-
-    for cs in changesets:
-        created_at = datetime.strptime(cs.get("created_at"), "%Y-%m-%dT%H:%M:%SZ")
-        changes_count = int(cs.get("changes_count", 0))
-        user_name = cs.get("user")
-        comments_count = int(cs.get("comments_count", 0))
-
-        if username is None:
-            username = user_name  # Store username
-
-        edit_days.add(created_at.date())
-        total_changes += changes_count
-        changeset_count += 1
-        weekday_edits[created_at.weekday()] += 1  # 0 = Monday, 6 = Sunday
-        hourly_edits[created_at.hour] += 1  # 0-23 UTC hours
-
-        if comments_count > 0:
-            changesets_with_comments += 1
-
-        if created_at >= LAST_30_DAYS:
-            last_30_days_changes += changes_count
-            active_edit_days_30.add(created_at.date())
-
-        # Extract editor and source usage
-        for tag in cs.findall("tag"):
-            key = tag.get("k")
-            value = tag.get("v")
-            if key == "created_by":
-                editor_usage[value] += 1
-            elif key == "source":
-                source_usage[value] += 1
-
-    return {
-        "user_id": user_id,
-        "username": username,
-        "first_edit": min(edit_days),
-        "last_edit": max(edit_days),
-        "total_edit_days": len(edit_days),
-        "active_edit_days_30": len(active_edit_days_30),
-        "total_changes": total_changes,
-        "last_30_days_changes": last_30_days_changes,
-        "most_used_editor": max(editor_usage, key=editor_usage.get, default="Unknown"),
-        "most_used_source": max(source_usage, key=source_usage.get, default="Unknown"),
-        "changeset_count": changeset_count,
-        "changesets_with_comments": changesets_with_comments,
-        "weekday_edits": dict(weekday_edits),  # Store as dictionary for later use
-        "hourly_edits": dict(hourly_edits),  # Store as dictionary for later use
-    }
-
-# Save user stats to a CSV file
-def save_to_csv(user_stats):
-    file_path = os.path.join(DATA_FOLDER, f"{user_stats['user_id']}.csv")
-    with open(file_path, "w", newline="", encoding="utf-8") as csvfile:
-        writer = csv.writer(csvfile)
-        writer.writerow(["User ID", "Username", "First Edit", "Last Edit", "Total Edit Days",
-                         "Active Edit Days (Last 30 Days)", "Total Changes", "Changes (Last 30 Days)",
-                         "Most Used Editor", "Most Used Source", "Total Changesets",
-                         "Changesets with Comments", "Edits Per Weekday", "Edits Per Hour"])
-        writer.writerow([
-            user_stats["user_id"],
-            user_stats["username"],
-            user_stats["first_edit"],
-            user_stats["last_edit"],
-            user_stats["total_edit_days"],
-            user_stats["active_edit_days_30"],
-            user_stats["total_changes"],
-            user_stats["last_30_days_changes"],
-            user_stats["most_used_editor"],
-            user_stats["most_used_source"],
-            user_stats["changeset_count"],
-            user_stats["changesets_with_comments"],
-            str(user_stats["weekday_edits"]),  # Convert dict to string
-            str(user_stats["hourly_edits"])  # Convert dict to string
-        ])
-    print(f"? Saved stats for {user_stats['username']} (User {user_stats['user_id']})")
-
-# Process users in batches
-async def process_users_in_batches():
-    async with aiohttp.ClientSession() as session:
-        tasks = []
-        for user_id in range(USER_ID_START, USER_ID_END + 1):
-            tasks.append(process_user(session, user_id))
-            if len(tasks) >= CONCURRENT_REQUESTS:  # Process in batches of 100
-                results = await asyncio.gather(*tasks)
-                for user_stats in results:
-                    if user_stats:
-                        save_to_csv(user_stats)
-                tasks = []  # Reset batch
-
-        # Process remaining users in the last batch
-        if tasks:
-            results = await asyncio.gather(*tasks)
-            for user_stats in results:
-                if user_stats:
-                    save_to_csv(user_stats)
+AGGREGATE_SECONDS = metrics.histogram("ogf_aggregate_seconds", "Time to compute one user's stats")
+
+# Parse a user's raw changeset pages and aggregate them, in one process pool
+# task in pipeline mode. Pages are in fetch order: newer copies of a changeset win.
+def stats_from_pages(user_id, pages, fetched_until):
+    changesets = {}
+    for page in pages:
+        for cs in ogfapi.parse_changesets_bytes(page):
+            changesets[cs.id] = cs
+    return stats.compute_stats(user_id, list(changesets.values()), fetched_until)
+
+# Process and extract user stats.
+# Users saved with an aggregate state only fetch the changesets closed since
+# their last fetch and fold them in. Everyone else (and every user when there
+# is no store to read, conn=None) gets their full history fetched and aggregated.
+async def process_user(client, conn, user_id):
+    saved_state = store.load_state(conn, user_id) if conn is not None else None
+    if saved_state is not None:
+        state = stats.state_from_json(saved_state)
+        await ogfapi.refresh_state(client, state)
+        # Saved even without new changesets: the 30-day figures still move on
+        return stats.stats_for_store(state)
+
+    fetched_at = datetime.utcnow().strftime(stats.TIME_FORMAT)
+    if client.executor is None:
+        changesets = await fetch_changesets(client, user_id)
+        if not changesets:
+            return None  # No edits found
+        with AGGREGATE_SECONDS.time():
+            return stats.compute_stats(user_id, changesets, fetched_at)
+
+    # Pipeline mode (--processes): paging only needs each page's size and oldest
+    # changeset, so the raw pages go to the pool once, to be parsed and
+    # aggregated in the same task (the time counts as aggregation), rather than
+    # parsed changesets being pickled back here and out again
+    pages = await ogfapi.fetch_pages(client, user_id, raw=True)
+    if not pages:
+        return None
+    with AGGREGATE_SECONDS.time():
+        return await client.run_cpu(stats_from_pages, user_id, pages, fetched_at)
+
+# One-line summary of the crawl metrics, printed with each progress line
+def metrics_summary():
+    requests = {result: counter.value for result, counter in ogfapi.REQUESTS.items()}
+    failed = requests["server_error"] + requests["client_error"] + requests["network_error"]
+    return (f"? {sum(requests.values())} requests ({requests['rate_limited']} rate limited, {failed} failed),"
+            f" latency p50 {ogfapi.REQUEST_SECONDS.quantile(0.5) * 1000:g} ms"
+            f" p99 {ogfapi.REQUEST_SECONDS.quantile(0.99) * 1000:g} ms,"
+            f" {ogfapi.BYTES_DOWNLOADED.value / 1e6:.1f} MB,"
+            f" parse {ogfapi.PARSE_SECONDS.sum:.1f} s, aggregate {AGGREGATE_SECONDS.sum:.1f} s,"
+            f" {RECORDS_WRITTEN.value} saved, writer queue {QUEUE_DEPTH.get()}")
+
+# Crawl the given user IDs with a pool of workers.
+# Finished users go to the writer stage, which saves them and their journal
+# entries in batches off the event loop (writer_options go to StatsWriter).
+# watch(scheduler), if given, runs alongside the crawl and may stop it.
+# Returns (complete, stopped).
+async def crawl_users(client, conn, user_ids, watch=None, **writer_options):
+    async with StatsWriter(**writer_options) as writer:
+        scheduler = Scheduler(lambda user_id: process_user(client, conn, user_id),
+                              workers=CONCURRENT_REQUESTS, on_result=writer.put, report=metrics_summary)
+        watcher = asyncio.create_task(watch(scheduler)) if watch is not None else None
+        try:
+            await scheduler.run(user_ids)
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+    print(metrics_summary())
+    complete = scheduler.done == len(user_ids) and scheduler.errors == 0 and writer.failed == 0
+    return complete, scheduler.stopping
+
+# Move the delta high-water mark forward (never backwards)
+def advance_high_water(conn, when):
+    current = store.get_meta(conn, HIGH_WATER_KEY)
+    if current is None or float(current) < when:
+        with conn:
+            store.set_meta(conn, HIGH_WATER_KEY, when)
+
+# Publish the stats as a snapshot for the app workers (see snapshot.py)
+def publish_snapshot(conn):
+    started = time.perf_counter()
+    count = snapshot.publish(conn)
+    print(f"? Published a snapshot of {count} users in {time.perf_counter() - started:.1f} s")
+
+# Process all users in the ID range.
+# An interrupted run picks up where it stopped and known-empty IDs are skipped for a while.
+async def process_all_users(executor=None, response_archive=None):
+    conn = store.connect()
+    run = journal.start_run(conn, "grab", USER_ID_START, USER_ID_END)
+    user_ids = journal.pending_ids(conn, run, range(USER_ID_START, USER_ID_END + 1),
+                                   EMPTY_RECHECK_DAYS * 86400)
+    print(f"? {'Resuming' if run['resumed'] else 'Starting'} crawl: {len(user_ids)} user IDs to check")
+    async with ApiClient(executor=executor, archive=response_archive) as client:
+        complete, _ = await crawl_users(client, conn, user_ids)
+    if complete:
+        journal.finish_run(conn, run)  # Otherwise the next run resumes and retries the failures
+        advance_high_water(conn, run["started_at"])
+    publish_snapshot(conn)
+
+# Crawl leased ranges (from leases.DatabaseLeases or leases.LockFileLeases)
+# until none are left to hand out; pending(first_id, last_id) lists the IDs of
+# a range to check. Each lease is renewed while its range is crawled; if it is
+# lost anyway (it expired and another worker took the range over), crawling the
+# range stops and the new owner checks it. Returns False if stopped by Ctrl-C.
+async def crawl_leases(client, conn, lease_queue, owner, pending, **writer_options):
+    while True:
+        lease = lease_queue.acquire(owner, LEASE_TTL)
+        if lease is None:
+            return True
+        first_id, last_id = lease
+        user_ids = pending(first_id, last_id)
+        print(f"? Leased IDs {first_id}-{last_id}: {len(user_ids)} to check")
+        lost = False
+
+        async def keep_lease(scheduler):
+            nonlocal lost
+            while True:
+                await asyncio.sleep(LEASE_TTL / 3)
+                if not lease_queue.renew(first_id, owner, LEASE_TTL):
+                    lost = True
+                    if not scheduler.stopping:  # A second stop() would cancel in-flight users
+                        scheduler.stop(f"? Lost the lease on IDs {first_id}-{last_id}, stopping this range")
+                    return
+
+        complete, stopped = await crawl_users(client, conn, user_ids, keep_lease, **writer_options)
+        if lost:
+            continue  # Not ours to complete or release any more
+        if stopped:
+            lease_queue.release(first_id, owner)
+            return False
+        lease_queue.complete(first_id, owner, errors=0 if complete else 1)
+
+# Sharded crawl on one host: any number of these worker processes take turns
+# leasing ranges of the run's IDs from the stats database until none are left.
+# Leases of workers that die expire and are handed out again.
+# For workers on several hosts, see process_shared_shard.
+async def process_shard(owner, executor=None, response_archive=None):
+    conn = store.connect()
+    run = journal.start_run(conn, "grab", USER_ID_START, USER_ID_END)
+    leases.plan(conn, run["run_id"], USER_ID_START, USER_ID_END, LEASE_SIZE)
+    print(f"? Worker {owner} joined crawl run {run['run_id']}")
+
+    def pending(first_id, last_id):
+        return journal.pending_ids(conn, run, range(first_id, last_id + 1), EMPTY_RECHECK_DAYS * 86400)
+
+    async with ApiClient(executor=executor, archive=response_archive) as client:
+        if not await crawl_leases(client, conn, leases.DatabaseLeases(conn, run["run_id"]), owner, pending):
+            return
+
+    # True for exactly one worker, once every range is done cleanly. Ranges that
+    # failed are checked again by the next --shard run, which then finishes the
+    # run; until then the app reads the new users from the database.
+    if leases.finish_run(conn, run):
+        advance_high_water(conn, run["started_at"])
+        publish_snapshot(conn)
+
+# Sharded crawl over several hosts sharing a folder (e.g. an NFS mount). The
+# stats database is in WAL mode and can't be shared that way, so leases are
+# lock files in the folder (see leases.LockFileLeases) and every worker saves
+# into its own result store there. Workers have no saved states to start
+# from, so they fetch every user's full history.
+# Exactly one worker, on the host with the stats database, runs with merge=True:
+# it keeps taking over ranges of workers that died until all are done, then
+# merges the result stores into the stats database and publishes the snapshot.
+# If ranges failed, the next run retries them and merges again.
+async def process_shared_shard(owner, folder, merge=False, executor=None, response_archive=None):
+    lease_queue = leases.LockFileLeases(os.path.join(folder, f"run-{USER_ID_START}-{USER_ID_END}"),
+                                        USER_ID_START, USER_ID_END, LEASE_SIZE)
+    started_at = lease_queue.start()
+    print(f"? Worker {owner} joined the crawl in {lease_queue.folder}")
+
+    def pending(first_id, last_id):
+        return list(range(first_id, last_id + 1))
+
+    async with ApiClient(executor=executor, archive=response_archive) as client:
+        while True:
+            if not await crawl_leases(client, None, lease_queue, owner, pending,
+                                      db_path=lease_queue.result_path(owner), use_journal=False, wal=False):
+                return
+            done, _, total = lease_queue.progress()
+            if not merge or done == total:
+                break
+            print(f"? {done} of {total} ranges done, waiting for the other workers")
+            await asyncio.sleep(LEASE_TTL / 3)
+
+    if merge and lease_queue.claim_merge(owner):
+        conn = store.connect()
+        for path in lease_queue.result_paths():
+            print(f"? Merged {store.merge_users(conn, path)} users from {os.path.basename(path)}")
+        _, failed, _ = lease_queue.progress()
+        if failed == 0:
+            advance_high_water(conn, started_at)
+        lease_queue.finish(failed == 0)
+        publish_snapshot(conn)
+
+# Re-save users whose 30-day figures are still counting down without new
+# changesets: delta runs only crawl users in the changeset feed, so these would
+# otherwise keep their old figures (and their leaderboard places) for good.
+# Their stored state is enough, no API calls are needed.
+def refresh_recent_figures(conn, crawled_ids):
+    crawled = set(crawled_ids)
+    rows = conn.execute("SELECT user_id, state FROM users WHERE active_edit_days_30 > 0 AND state IS NOT NULL")
+    stats_list = [stats.stats_for_store(stats.state_from_json(state)) for user_id, state in rows.fetchall()
+                  if user_id not in crawled]
+    store.save_users(conn, stats_list)
+    print(f"? Recomputed the 30-day figures of {len(stats_list)} users without new changesets")
+
+# Only refresh users who created or closed changesets since the last run,
+# found through the global changesets feed.
+async def process_recent_users(executor=None, response_archive=None):
+    conn = store.connect()
+    high_water = store.get_meta(conn, HIGH_WATER_KEY)
+    if high_water is None:
+        print("? No previous run recorded, run a full crawl first (python grab.py)")
+        return
+    start = datetime.utcfromtimestamp(float(high_water))
+    now = datetime.utcnow()
+    async with ApiClient(executor=executor, archive=response_archive) as client:
+        user_ids = await fetch_active_user_ids(client, start, now)
+        print(f"? {len(user_ids)} users active since {start:%Y-%m-%d %H:%M} UTC")
+        complete, _ = await crawl_users(client, conn, user_ids)
+    refresh_recent_figures(conn, user_ids)
+    if complete:
+        advance_high_water(conn, now.replace(tzinfo=timezone.utc).timestamp())
+    publish_snapshot(conn)
+
+# Rebuild one user's stats from their archived responses (in the process pool with --processes)
+def replay_user(folder, user_id, responses):
+    pages = [archive.read_object(folder, digest) for digest, _ in responses]  # Oldest fetch first
+    # The earliest fetch is a safe "fetched until": later incremental fetches
+    # may see a few changesets again, but folding skips those
+    fetched_until = datetime.utcfromtimestamp(min(fetched_at for _, fetched_at in responses))
+    return stats_from_pages(user_id, pages, fetched_until.strftime(stats.TIME_FORMAT))
+
+# Rebuild every archived user's stats from the response archive, without any API calls
+async def replay_archive(executor=None, workers=1):
+    response_archive = archive.ResponseArchive()
+    user_ids = response_archive.user_ids()
+    print(f"? Replaying {len(user_ids)} users from {response_archive.folder}")
+    loop = asyncio.get_running_loop()
+
+    async def replay(user_id):
+        responses = response_archive.responses(user_id)
+        if executor is None:
+            return replay_user(response_archive.folder, user_id, responses)
+        return await loop.run_in_executor(executor, replay_user, response_archive.folder, user_id, responses)
+
+    async with StatsWriter(use_journal=False) as writer:
+        scheduler = Scheduler(replay, workers=workers, on_result=writer.put)
+        await scheduler.run(user_ids)
+    response_archive.close()
+    publish_snapshot(store.connect())
 
 # Run script
 if __name__ == "__main__":
-    asyncio.run(process_users_in_batches())
+    parser = argparse.ArgumentParser(description="Crawl OpenGeofiction user stats")
+    parser.add_argument("--delta", action="store_true",
+                        help="only refresh users with changesets since the last run")
+    parser.add_argument("--processes", type=int, default=0,
+                        help="parse and aggregate in this many worker processes (default: on the event loop)")
+    parser.add_argument("--archive", action="store_true",
+                        help=f"keep the raw API responses in {archive.ARCHIVE_FOLDER} for --replay")
+    parser.add_argument("--shard", action="store_true",
+                        help="crawl as one of several worker processes sharing the ID range through leases"
+                             " (on this host, or on several with --shared-folder)")
+    parser.add_argument("--shared-folder",
+                        help="with --shard: lease ranges and save results in this folder shared between hosts")
+    parser.add_argument("--merge", action="store_true",
+                        help="with --shared-folder: wait for all ranges, then merge the results into the stats"
+                             " database (run exactly one such worker, on the host serving the app)")
+    parser.add_argument("--worker-id", default=f"{socket.gethostname()}:{os.getpid()}",
+                        help="name of this worker in the leases (default: host:pid)")
+    parser.add_argument("--replay", action="store_true",
+                        help="rebuild all stats from the response archive instead of the API")
+    args = parser.parse_args()
+    executor = None
+    if args.processes > 0:
+        # Workers ignore Ctrl-C so the scheduler can shut down gracefully
+        executor = ProcessPoolExecutor(max_workers=args.processes, initializer=signal.signal,
+                                       initargs=(signal.SIGINT, signal.SIG_IGN))
+    try:
+        if args.replay:
+            asyncio.run(replay_archive(executor, workers=max(args.processes * 2, 1)))
+        else:
+            response_archive = archive.ResponseArchive() if args.archive else None
+            if args.shard and args.shared_folder:
+                asyncio.run(process_shared_shard(args.worker_id, args.shared_folder, args.merge,
+                                                 executor, response_archive))
+            elif args.shard:
+                asyncio.run(process_shard(args.worker_id, executor, response_archive))
+            elif args.delta:
+                asyncio.run(process_recent_users(executor, response_archive))
+            else:
+                asyncio.run(process_all_users(executor, response_archive))
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
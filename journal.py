@@ -0,0 +1,81 @@
+import time
+
+# Outcomes recorded for each checked user ID
+HAS_DATA = "data"
+EMPTY = "empty"
+ERROR = "error"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS crawl_journal (
+    user_id INTEGER PRIMARY KEY,
+    outcome TEXT NOT NULL,
+    checked_at REAL NOT NULL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS crawl_runs (
+    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    first_id INTEGER NOT NULL,
+    last_id INTEGER NOT NULL,
+    started_at REAL NOT NULL,
+    finished_at REAL
+);
+"""
+
+# Create the journal tables in the stats database if needed
+def init(conn):
+    conn.executescript(SCHEMA)
+
+# Resume the last unfinished run over the same ID range, or start a new one.
+# Runs in one immediate transaction, so workers of a sharded crawl that start
+# at the same time all join the same run.
+def start_run(conn, name, first_id, last_id):
+    init(conn)
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT run_id, started_at FROM crawl_runs WHERE name = ? AND first_id = ? AND last_id = ?"
+                           " AND finished_at IS NULL ORDER BY run_id DESC LIMIT 1",
+                           (name, first_id, last_id)).fetchone()
+        if row:
+            return {"run_id": row[0], "started_at": row[1], "resumed": True}
+        started_at = time.time()
+        cursor = conn.execute("INSERT INTO crawl_runs (name, first_id, last_id, started_at) VALUES (?, ?, ?, ?)",
+                              (name, first_id, last_id, started_at))
+    return {"run_id": cursor.lastrowid, "started_at": started_at, "resumed": False}
+
+def finish_run(conn, run):
+    with conn:
+        conn.execute("UPDATE crawl_runs SET finished_at = ? WHERE run_id = ?", (time.time(), run["run_id"]))
+
+# IDs from user_ids that still need checking in this run.
+# Skips IDs already completed since the run started, and IDs known to be
+# empty that were checked less than empty_ttl seconds ago.
+def pending_ids(conn, run, user_ids, empty_ttl):
+    user_ids = list(user_ids)
+    if not user_ids:
+        return user_ids
+    rows = conn.execute("SELECT user_id, outcome, checked_at FROM crawl_journal WHERE user_id BETWEEN ? AND ?",
+                        (min(user_ids), max(user_ids)))
+    empty_after = time.time() - empty_ttl
+    done = set()
+    for user_id, outcome, checked_at in rows:
+        if outcome != ERROR and checked_at >= run["started_at"]:
+            done.add(user_id)
+        elif outcome == EMPTY and checked_at >= empty_after:
+            done.add(user_id)
+    return [user_id for user_id in user_ids if user_id not in done]
+
+# Outcome for a finished user: stats, nothing, or an exception
+def outcome_of(user_stats, error=None):
+    if error is not None:
+        return ERROR
+    return HAS_DATA if user_stats else EMPTY
+
+# Record journal entries inside the caller's transaction
+def write_entries(conn, entries):
+    if not entries:
+        return
+    checked_at = time.time()
+    conn.executemany("INSERT OR REPLACE INTO crawl_journal (user_id, outcome, checked_at, error) VALUES (?, ?, ?, ?)",
+                     [(user_id, outcome, checked_at, str(error) if error else None)
+                      for user_id, outcome, error in entries])
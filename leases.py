@@ -0,0 +1,262 @@
+import os
+import re
+import json
+import time
+
+# Lease states for ID ranges
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS crawl_leases (
+    run_id INTEGER NOT NULL,
+    first_id INTEGER NOT NULL,
+    last_id INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    owner TEXT,
+    expires_at REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    errors INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (run_id, first_id)
+);
+"""
+
+# Shared work queues for sharded crawls, in two flavours with the same methods
+# (acquire, renew, complete, release):
+# - DatabaseLeases, for worker processes on one host: the ranges live in the
+#   stats database (WAL mode, so it can't be shared between hosts).
+# - LockFileLeases, for workers on several hosts sharing a folder (e.g. over
+#   NFS): one lock file per leased range, no database locking needed.
+# A run's ID range is split into fixed-size ranges and workers lease one at a
+# time. A lease expires unless its owner renews it, so ranges held by a worker
+# that died are handed out again, and two workers never hold the same range.
+
+def init(conn):
+    conn.executescript(SCHEMA)
+
+# Split a run into ranges of `size` IDs (once per run; later calls only
+# reopen ranges that finished with errors, so they are retried)
+def plan(conn, run_id, first_id, last_id, size):
+    init(conn)
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany("INSERT OR IGNORE INTO crawl_leases (run_id, first_id, last_id, state) VALUES (?, ?, ?, ?)",
+                         [(run_id, start, min(start + size - 1, last_id), PENDING)
+                          for start in range(first_id, last_id + 1, size)])
+        conn.execute("UPDATE crawl_leases SET state = ?, errors = 0 WHERE run_id = ? AND state = ? AND errors > 0",
+                     (PENDING, run_id, DONE))
+
+# Lease the next free range (or one whose lease has expired) for ttl seconds.
+# Returns (first_id, last_id), or None when there is nothing left to hand out.
+def acquire(conn, run_id, owner, ttl):
+    now = time.time()
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT first_id, last_id FROM crawl_leases WHERE run_id = ?"
+                           " AND (state = ? OR (state = ? AND expires_at < ?)) ORDER BY first_id LIMIT 1",
+                           (run_id, PENDING, LEASED, now)).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE crawl_leases SET state = ?, owner = ?, expires_at = ?, attempts = attempts + 1"
+                     " WHERE run_id = ? AND first_id = ?", (LEASED, owner, now + ttl, run_id, row[0]))
+    return row
+
+# Extend a lease; False if it was lost (expired and taken over by another worker)
+def renew(conn, run_id, first_id, owner, ttl):
+    with conn:
+        cursor = conn.execute("UPDATE crawl_leases SET expires_at = ? WHERE run_id = ? AND first_id = ?"
+                              " AND state = ? AND owner = ?", (time.time() + ttl, run_id, first_id, LEASED, owner))
+    return cursor.rowcount == 1
+
+# Mark a leased range as crawled; with errors, the next plan() for this run reopens it
+def complete(conn, run_id, first_id, owner, errors=0):
+    with conn:
+        conn.execute("UPDATE crawl_leases SET state = ?, errors = ?, expires_at = NULL WHERE run_id = ?"
+                     " AND first_id = ? AND owner = ?", (DONE, errors, run_id, first_id, owner))
+
+# Give a range back unfinished (e.g. on Ctrl-C) so another worker can take it
+def release(conn, run_id, first_id, owner):
+    with conn:
+        conn.execute("UPDATE crawl_leases SET state = ?, owner = NULL, expires_at = NULL WHERE run_id = ?"
+                     " AND first_id = ? AND owner = ?", (PENDING, run_id, first_id, owner))
+
+# Mark the run finished if every range is done without errors.
+# Only one worker gets True, so only one runs the end-of-run steps.
+def finish_run(conn, run):
+    with conn:
+        cursor = conn.execute("UPDATE crawl_runs SET finished_at = ? WHERE run_id = ? AND finished_at IS NULL"
+                              " AND NOT EXISTS (SELECT 1 FROM crawl_leases WHERE run_id = ?"
+                              " AND (state != ? OR errors > 0))",
+                              (time.time(), run["run_id"], run["run_id"], DONE))
+    return cursor.rowcount == 1
+
+# The functions above bound to one run, with the same methods as LockFileLeases
+class DatabaseLeases:
+    def __init__(self, conn, run_id):
+        self.conn = conn
+        self.run_id = run_id
+
+    def acquire(self, owner, ttl):
+        return acquire(self.conn, self.run_id, owner, ttl)
+
+    def renew(self, first_id, owner, ttl):
+        return renew(self.conn, self.run_id, first_id, owner, ttl)
+
+    def complete(self, first_id, owner, errors=0):
+        complete(self.conn, self.run_id, first_id, owner, errors)
+
+    def release(self, first_id, owner):
+        release(self.conn, self.run_id, first_id, owner)
+
+# File name part for an owner such as "host:1234"
+def safe_name(owner):
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", owner)
+
+# Leases for workers on several hosts, kept as files in a shared run folder:
+#   run                 start time of the run
+#   leases/<first>.lock  owner of a leased range; its mtime is the last renewal
+#   done/<first>         a finished range, holding its error count
+#   results/<owner>.db   each worker's own result store (see grab.py --shared-folder)
+#   merged               claimed by the worker that merges the results
+# Files are created by writing a private temp file and hard-linking it into
+# place, which is atomic and fails if the name exists, also over NFS (where
+# O_EXCL has not always been reliable). Expiry is judged by the file server's
+# clock: "now" is read from the mtime of a file this worker just touched, so
+# hosts with skewed clocks still agree on which leases are stale.
+class LockFileLeases:
+    def __init__(self, folder, first_id, last_id, size):
+        self.folder = folder
+        self.ranges = [(start, min(start + size - 1, last_id)) for start in range(first_id, last_id + 1, size)]
+        for name in ("leases", "done", "results", "tmp"):
+            os.makedirs(os.path.join(folder, name), exist_ok=True)
+
+    def _path(self, *parts):
+        return os.path.join(self.folder, *parts)
+
+    def _lock_path(self, first_id):
+        return self._path("leases", f"{first_id}.lock")
+
+    def _done_path(self, first_id):
+        return self._path("done", str(first_id))
+
+    # Create a file with the given text unless it exists; True if this call created it
+    def _create(self, path, text):
+        temp_path = self._path("tmp", f"{safe_name(text)}.{os.getpid()}.{time.monotonic_ns()}")
+        with open(temp_path, "w") as file:
+            file.write(text)
+        try:
+            os.link(temp_path, path)
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(temp_path)
+
+    def _read(self, path):
+        try:
+            with open(path) as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    # Current time on the file server
+    def _now(self, owner):
+        path = self._path("tmp", f"clock.{safe_name(owner)}")
+        with open(path, "w"):
+            pass
+        return os.stat(path).st_mtime
+
+    # Join the run (the first worker records its start time) and reopen ranges
+    # that finished with errors, so they are retried. Returns the start time.
+    def start(self):
+        self._create(self._path("run"), json.dumps({"started_at": time.time()}))
+        for first_id, _ in self.ranges:
+            errors = self._read(self._done_path(first_id))
+            if errors is not None and int(errors) > 0:
+                os.remove(self._done_path(first_id))
+        return json.loads(self._read(self._path("run")))["started_at"]
+
+    # Lease the next free range, or one whose lease has expired.
+    # Returns (first_id, last_id), or None when there is nothing left to hand out.
+    def acquire(self, owner, ttl):
+        now = None
+        for first_id, last_id in self.ranges:
+            if os.path.exists(self._done_path(first_id)):
+                continue
+            lock_path = self._lock_path(first_id)
+            if self._create(lock_path, owner):
+                return first_id, last_id
+            try:
+                renewed = os.stat(lock_path).st_mtime
+            except FileNotFoundError:
+                continue  # Just completed or released; the next call sees which
+            now = self._now(owner) if now is None else now
+            if now - renewed > ttl and self._take_over(lock_path, ttl, now, owner):
+                return first_id, last_id
+        return None
+
+    # Replace an expired lock. Renaming it away is atomic, so only one of several
+    # workers racing for it gets it; if the renamed lock turns out to have been
+    # renewed or replaced in the meantime, it is put back.
+    def _take_over(self, lock_path, ttl, now, owner):
+        stale_path = f"{lock_path}.{safe_name(owner)}.stale"
+        try:
+            os.rename(lock_path, stale_path)
+        except FileNotFoundError:
+            return False
+        if now - os.stat(stale_path).st_mtime <= ttl:
+            try:
+                os.link(stale_path, lock_path)
+            except FileExistsError:
+                pass
+            os.remove(stale_path)
+            return False
+        os.remove(stale_path)
+        return self._create(lock_path, owner)
+
+    # Extend a lease; False if it was lost (expired and taken over by another worker)
+    def renew(self, first_id, owner, ttl):
+        lock_path = self._lock_path(first_id)
+        if self._read(lock_path) != owner:
+            return False
+        os.utime(lock_path)  # Sets the file server's time
+        return True
+
+    # Mark a leased range as crawled; with errors, the next worker to start() reopens it
+    def complete(self, first_id, owner, errors=0):
+        if self._read(self._lock_path(first_id)) == owner:
+            self._create(self._done_path(first_id), str(errors))
+            os.remove(self._lock_path(first_id))
+
+    # Give a range back unfinished (e.g. on Ctrl-C) so another worker can take it
+    def release(self, first_id, owner):
+        if self._read(self._lock_path(first_id)) == owner:
+            os.remove(self._lock_path(first_id))
+
+    # (ranges done, ranges done with errors, ranges in all)
+    def progress(self):
+        done = [self._read(self._done_path(first_id)) for first_id, _ in self.ranges]
+        finished = [int(errors) for errors in done if errors is not None]
+        return len(finished), sum(1 for errors in finished if errors > 0), len(self.ranges)
+
+    def result_path(self, owner):
+        return self._path("results", f"{safe_name(owner)}.db")
+
+    def result_paths(self):
+        folder = self._path("results")
+        return sorted(os.path.join(folder, name) for name in os.listdir(folder) if name.endswith(".db"))
+
+    # Claim the merge once every range is done; True for exactly one worker
+    def claim_merge(self, owner):
+        done, _, total = self.progress()
+        return done == total and self._create(self._path("merged"), owner)
+
+    # After the merge: move a complete run aside, so the next one starts afresh;
+    # otherwise drop the merge claim, so the next run retries the failed ranges
+    # and merges again
+    def finish(self, complete):
+        if complete:
+            os.rename(self.folder, f"{self.folder}-merged-{int(time.time())}")
+        else:
+            os.remove(self._path("merged"))
@@ -0,0 +1,126 @@
+import time
+import asyncio
+import threading
+import store
+import stats
+
+# Seconds a web request waits for a live fetch before giving up
+FETCH_TIMEOUT = 20
+
+# Records older than this (seconds) are refreshed in the background
+STALE_AFTER = 24 * 3600
+
+# Seconds to remember that a user has no changesets, so repeated searches don't hit the API
+NEGATIVE_TTL = 300
+
+# Most users remembered as having no changesets (the oldest are forgotten first)
+MAX_MISSING = 10000
+
+# Fetches users on demand for the web app.
+# A single asyncio loop runs in a background thread with one shared
+# ApiClient; the thread and the HTTP stack (ogfapi, aiohttp) are only
+# started on the first fetch, so they don't slow down app startup.
+# Requests for the same user are coalesced (single-flight): while
+# a fetch is running, every other request for that user waits on it instead
+# of starting its own. Results are written to the store, so later lookups are
+# served from the database and the app's cache.
+class LiveFetcher:
+    def __init__(self, db_path=store.DB_PATH):
+        self.db_path = db_path
+        self.loop = None
+        self.thread = None
+        self.start_lock = threading.Lock()
+        self.client = None
+        self.conn = None
+        self.in_flight = {}  # Key -> asyncio.Task, only touched on the loop thread
+        self.missing = {}  # Key -> time a fetch found nothing, oldest first
+        self.upstream_fetches = 0
+        self.coalesced = 0
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    # Run a coroutine on the fetch loop, starting the loop thread on first use
+    def _submit(self, coroutine):
+        with self.start_lock:
+            if self.thread is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=self._run_loop, name="live-fetch", daemon=True)
+                self.thread.start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    # Fetch a user by ID (int) or username (str) and save them; blocks the calling thread.
+    # Returns the user ID, or None if the user has no changesets or the fetch failed.
+    def fetch(self, user, timeout=FETCH_TIMEOUT):
+        future = self._submit(self._fetch_coalesced(user))
+        try:
+            return future.result(timeout)
+        except Exception as e:
+            print(f"? Live fetch for {user!r} failed: {e!r}")
+            return None
+
+    # Start a fetch without waiting for it (used to refresh stale records)
+    def refresh(self, user):
+        self._submit(self._fetch_coalesced(user))
+
+    async def _fetch_coalesced(self, user):
+        key = store.username_key(user) if isinstance(user, str) else int(user)
+        missing_since = self.missing.get(key)
+        if missing_since is not None and time.monotonic() - missing_since < NEGATIVE_TTL:
+            return None
+        task = self.in_flight.get(key)
+        if task is None:
+            task = self.loop.create_task(self._fetch(user))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        else:
+            self.coalesced += 1
+        user_id = await asyncio.shield(task)  # A caller timing out mustn't cancel everyone else's fetch
+        if user_id is None:
+            self._remember_missing(key)
+        return user_id
+
+    # Remember a user with no changesets. Visitors can type any number of
+    # unknown names, so expired entries are dropped as new ones come in
+    # (the dictionary is kept in time order) and its size is capped.
+    def _remember_missing(self, key):
+        now = time.monotonic()
+        self.missing.pop(key, None)
+        self.missing[key] = now
+        while self.missing:
+            old_key = next(iter(self.missing))
+            if now - self.missing[old_key] < NEGATIVE_TTL and len(self.missing) <= MAX_MISSING:
+                break
+            del self.missing[old_key]
+
+    async def _fetch(self, user):
+        import ogfapi  # Deferred: pulls in aiohttp
+        if self.client is None:
+            self.client = ogfapi.ApiClient()
+            await self.client.__aenter__()
+            self.conn = store.connect(self.db_path)
+        self.upstream_fetches += 1
+
+        if isinstance(user, str):
+            user_id = await ogfapi.find_user_id(self.client, user)
+            if user_id is None:
+                return None
+        else:
+            user_id = user
+
+        # Users saved with an aggregate state only need their new changesets
+        state, _ = await ogfapi.refresh_user(self.client, self.conn, user_id)
+        user_stats = stats.stats_for_store(state)
+        if user_stats is None:
+            return None
+        store.save_user(self.conn, user_stats)
+        return user_id
+
+    def stats(self):
+        return {
+            "upstream_fetches": self.upstream_fetches,
+            "coalesced": self.coalesced,
+            "in_flight": len(self.in_flight),
+            "remembered_missing": len(self.missing),
+        }
@@ -0,0 +1,138 @@
+import time
+import bisect
+import threading
+
+# In-process metrics: counters, gauges and fixed-bucket histograms, rendered
+# in the Prometheus text format. Updating a metric is a lock and an addition
+# (plus a binary search for histograms), cheap enough to leave on everywhere.
+# Look metrics up once at import time and keep the handle, e.g.
+#   REQUESTS = metrics.counter("ogf_api_requests_total", "API requests", result="ok")
+
+# Histogram bucket upper bounds in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+# A gauge is either set() explicitly or reads its value from function() when rendered
+class Gauge:
+    def __init__(self, function=None):
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+    def samples(self, name, labels):
+        yield name, labels, self.get()
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # The last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        slot = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[slot] += 1
+            self.sum += value
+            self.count += 1
+
+    # Time a block: "with HISTOGRAM.time(): ..."
+    def time(self):
+        return _Timer(self)
+
+    # Estimate a quantile as the upper bound of the bucket it falls in
+    def quantile(self, fraction):
+        with self.lock:
+            counts, total = list(self.counts), self.count
+        if total == 0:
+            return 0.0
+        target = fraction * total
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+    def samples(self, name, labels):
+        with self.lock:
+            counts, total, value_sum = list(self.counts), self.count, self.sum
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            seen += count
+            yield f"{name}_bucket", labels + (("le", _format_value(bound)),), seen
+        yield f"{name}_sum", labels, value_sum
+        yield f"{name}_count", labels, total
+
+class _Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+# Metric name -> (type, help, {labels: metric})
+REGISTRY = {}
+REGISTRY_LOCK = threading.Lock()
+
+def _get(kind, name, help, labels, make):
+    key = tuple(sorted(labels.items()))
+    with REGISTRY_LOCK:
+        family = REGISTRY.setdefault(name, (kind, help, {}))
+        if family[0] != kind:
+            raise ValueError(f"Metric {name} is already registered as a {family[0]}")
+        metric = family[2].get(key)
+        if metric is None:
+            metric = family[2][key] = make()
+        return metric
+
+def counter(name, help, **labels):
+    return _get("counter", name, help, labels, Counter)
+
+def gauge(name, help, function=None, **labels):
+    return _get("gauge", name, help, labels, lambda: Gauge(function))
+
+def histogram(name, help, buckets=LATENCY_BUCKETS, **labels):
+    return _get("histogram", name, help, labels, lambda: Histogram(buckets))
+
+def _format_value(value):
+    return "+Inf" if value == float("inf") else str(value)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+# All metrics in the Prometheus text exposition format
+def render():
+    with REGISTRY_LOCK:
+        families = sorted((name, kind, help, list(children.items())) for name, (kind, help, children) in REGISTRY.items())
+    lines = []
+    for name, kind, help, children in families:
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, metric in sorted(children, key=lambda child: child[0]):
+            for sample_name, sample_labels, value in metric.samples(name, labels):
+                label_text = ",".join(f'{key}="{_escape(label)}"' for key, label in sample_labels)
+                lines.append(f"{sample_name}{{{label_text}}} {_format_value(value)}" if label_text
+                             else f"{sample_name} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
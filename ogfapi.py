@@ -0,0 +1,430 @@
+import os
+import re
+import time
+import random
+import asyncio
+import aiohttp
+from urllib.parse import quote
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from stats import Changeset
+import stats
+import store
+import metrics
+
+# OpenGeofiction API (OSM API 0.6); OGF_API_URL points the crawlers elsewhere, e.g. at bench/mockapi.py
+API_URL = os.environ.get("OGF_API_URL", "https://opengeofiction.net/api/0.6").rstrip("/")
+
+# The changesets endpoint returns at most this many changesets per request
+PAGE_SIZE = 100
+
+# Nothing on OpenGeofiction is older than this
+HISTORY_START = datetime(2008, 1, 1)
+
+# How many time windows to fetch concurrently when a user's history doesn't fit in one page
+WINDOW_SPLIT = 8
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+# Size of the chunks fed from the response body into the XML parser
+CHUNK_SIZE = 64 * 1024
+
+# Concurrency bounds for the adaptive limiter (see AdaptiveLimit)
+MIN_CONCURRENCY = 4
+INITIAL_CONCURRENCY = 16
+MAX_CONCURRENCY = 100
+
+# Retry policy for transient errors
+RETRIES = 5
+BACKOFF_BASE = 0.5  # Seconds
+BACKOFF_CAP = 60.0
+
+# Statuses worth retrying, and statuses that just mean "nothing here"
+TRANSIENT_STATUSES = {408, 429, 500, 502, 503, 504, 509}
+EMPTY_STATUSES = {404, 410}
+
+# Rate limiting: 429, or 509 Bandwidth Limit Exceeded, which the OSM 0.6 API
+# sends when a client downloads too much; both come with a Retry-After
+RATE_LIMIT_STATUSES = {429, 509}
+
+# Back off when smoothed latency goes above this multiple of the best seen so far
+LATENCY_TOLERANCE = 2.0
+
+# Minimum seconds between two multiplicative decreases of the limit
+DECREASE_INTERVAL = 1.0
+
+REQUEST_SECONDS = metrics.histogram("ogf_api_request_seconds", "Time to response headers for API requests")
+PARSE_SECONDS = metrics.histogram("ogf_api_parse_seconds", "Time spent parsing one changesets response")
+BYTES_DOWNLOADED = metrics.counter("ogf_api_bytes_total", "Changeset XML downloaded")
+REQUESTS = {result: metrics.counter("ogf_api_requests_total", "API requests by result", result=result)
+            for result in ("ok", "not_found", "rate_limited", "server_error", "client_error", "network_error")}
+
+def _result_of(status):
+    if status == 200:
+        return "ok"
+    if status in EMPTY_STATUSES:
+        return "not_found"
+    if status in RATE_LIMIT_STATUSES:
+        return "rate_limited"
+    return "server_error" if status >= 500 else "client_error"
+
+# Build a compact record from a finished <changeset> element
+def changeset_from_element(elem):
+    created_by = None
+    source = None
+    for tag in elem.iter("tag"):
+        key = tag.get("k")
+        if key == "created_by":
+            created_by = tag.get("v")
+        elif key == "source":
+            source = tag.get("v")
+    return Changeset(
+        int(elem.get("id")),
+        elem.get("created_at"),
+        int(elem.get("changes_count", 0)),
+        int(elem.get("comments_count", 0)),
+        created_by,
+        source,
+        elem.get("user"),
+        int(elem.get("uid", 0)),
+        elem.get("open") == "true",
+    )
+
+# Incremental parser turning <changeset> elements into compact records.
+# Each element is cleared as soon as it has been converted, so memory use
+# doesn't grow with the size of the response.
+class ChangesetReader:
+    def __init__(self):
+        self.parser = ET.XMLPullParser(events=("start", "end"))
+        self.root = None
+        self.changesets = []
+
+    def feed(self, chunk):
+        self.parser.feed(chunk)
+        for event, elem in self.parser.read_events():
+            if event == "start":
+                if self.root is None:
+                    self.root = elem
+            elif elem.tag == "changeset":
+                self.changesets.append(changeset_from_element(elem))
+                elem.clear()
+                self.root.clear()  # Drop the cleared element from the document too
+
+    def close(self):
+        self.parser.close()
+        return self.changesets
+
+# Parse a changesets response chunk by chunk as it arrives.
+# Only the time spent in the parser counts as parse time, not waiting for chunks.
+async def parse_changesets(content):
+    reader = ChangesetReader()
+    parse_time = 0.0
+    async for chunk in content.iter_chunked(CHUNK_SIZE):
+        BYTES_DOWNLOADED.inc(len(chunk))
+        started = time.perf_counter()
+        reader.feed(chunk)
+        parse_time += time.perf_counter() - started
+    started = time.perf_counter()
+    changesets = reader.close()
+    PARSE_SECONDS.observe(parse_time + time.perf_counter() - started)
+    return changesets
+
+# Parse a complete response body (used in worker processes)
+def parse_changesets_bytes(body):
+    reader = ChangesetReader()
+    reader.feed(body)
+    return reader.close()
+
+# Creation times in a raw changesets response, one per changeset (only the
+# changeset elements carry the attribute; quotes in tag values are escaped)
+CREATED_AT = re.compile(rb' created_at="([^"]*)"')
+
+# Raised when a request fails permanently or keeps failing after all retries
+class ApiError(Exception):
+    pass
+
+# AIMD concurrency limit: grows by about one slot per round of successful
+# requests and halves on throttling, errors, or when latency climbs well
+# above the best observed, so the crawl settles at what the server tolerates.
+class AdaptiveLimit:
+    def __init__(self, initial=INITIAL_CONCURRENCY, minimum=MIN_CONCURRENCY, maximum=MAX_CONCURRENCY):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+        self.latency = None  # Smoothed latency (EWMA)
+        self.baseline = None  # Best smoothed latency, drifting up slowly
+        self.last_decrease = 0.0
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def on_success(self, seconds):
+        self.latency = seconds if self.latency is None else 0.9 * self.latency + 0.1 * seconds
+        self.baseline = self.latency if self.baseline is None else min(self.baseline * 1.001, self.latency)
+        if self.latency > self.baseline * LATENCY_TOLERANCE:
+            self._decrease(0.9)
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def on_overload(self):
+        self._decrease(0.5)
+
+    def _decrease(self, factor):
+        now = time.monotonic()
+        if now - self.last_decrease < DECREASE_INTERVAL:
+            return  # One decrease per burst of failures is enough
+        self.limit = max(self.minimum, self.limit * factor)
+        self.last_decrease = now
+
+# Seconds to wait from a Retry-After header (either seconds or an HTTP date)
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+# Full-jitter exponential backoff
+def backoff_delay(attempt):
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+# Shared API client: one tuned connection pool, adaptive concurrency and
+# retries for transient errors. Use as "async with ApiClient() as client".
+# With an executor (a ProcessPoolExecutor), response bodies are only read on
+# the event loop and parsed in the pool, and run_cpu() sends aggregation
+# there too, so CPU work doesn't hold up the sockets. With an archive (see
+# archive.py), every changesets response is also stored raw before parsing.
+class ApiClient:
+    def __init__(self, session=None, limit=None, retries=RETRIES, executor=None, archive=None):
+        self.session = session
+        self.owns_session = session is None
+        self.limit = limit or AdaptiveLimit()
+        self.retries = retries
+        self.executor = executor
+        self.archive = archive
+        self.paused_until = 0.0
+
+    async def __aenter__(self):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(
+                limit=MAX_CONCURRENCY,
+                limit_per_host=MAX_CONCURRENCY,  # Everything goes to one host
+                ttl_dns_cache=300,
+                keepalive_timeout=30,
+                enable_cleanup_closed=True,
+            )
+            timeout = aiohttp.ClientTimeout(total=60, connect=10, sock_read=30)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self.owns_session:
+            await self.session.close()
+
+    # Hold every request while the server has asked us to back off
+    async def _wait_for_pause(self):
+        delay = self.paused_until - time.monotonic()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.paused_until - time.monotonic()
+
+    # GET a URL and return await parse(response) for a 200, or [] for 404/410.
+    # Transient failures are retried; anything else raises ApiError.
+    async def get(self, url, parse):
+        error = None
+        for attempt in range(self.retries + 1):
+            await self._wait_for_pause()
+            await self.limit.acquire()
+            started = time.monotonic()
+            retry_after = None
+            try:
+                async with self.session.get(url) as response:
+                    latency = time.monotonic() - started  # Time to response headers
+                    REQUEST_SECONDS.observe(latency)
+                    REQUESTS[_result_of(response.status)].inc()
+                    if response.status == 200:
+                        result = await parse(response)
+                        self.limit.on_success(latency)
+                        return result
+                    if response.status in EMPTY_STATUSES:
+                        self.limit.on_success(latency)
+                        return []
+                    if response.status not in TRANSIENT_STATUSES:
+                        raise ApiError(f"HTTP {response.status} for {url}")
+                    error = f"HTTP {response.status}"
+                    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                    self.limit.on_overload()
+            except (aiohttp.ClientError, asyncio.TimeoutError, ET.ParseError) as e:
+                if not isinstance(e, ET.ParseError):  # A malformed body was already counted by its status
+                    REQUESTS["network_error"].inc()
+                error = repr(e)
+                self.limit.on_overload()
+            finally:
+                await self.limit.release()
+
+            if retry_after is not None:
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            else:
+                await asyncio.sleep(backoff_delay(attempt))
+        raise ApiError(f"Giving up on {url} after {self.retries + 1} attempts: {error}")
+
+    # GET a changesets URL and return the raw response body (b"" for 404/410)
+    async def get_body(self, url):
+        body = await self.get(url, lambda response: response.read())
+        if not body:
+            return b""
+        BYTES_DOWNLOADED.inc(len(body))
+        if self.archive is not None:
+            await asyncio.to_thread(self.archive.put, url, body)  # Compressing and writing stay off the loop
+        return body
+
+    # GET a changesets URL and return its compact changeset records
+    async def get_changesets(self, url):
+        if self.executor is None and self.archive is None:
+            return await self.get(url, lambda response: parse_changesets(response.content))
+        body = await self.get_body(url)
+        if not body:
+            return []
+        try:
+            with PARSE_SECONDS.time():  # Includes the hand-off to the worker process
+                return await self.run_cpu(parse_changesets_bytes, body)
+        except ET.ParseError as e:
+            raise ApiError(f"Malformed response from {url}: {e}")
+
+    # Run func(*args) in the executor if there is one, inline otherwise
+    async def run_cpu(self, func, *args):
+        if self.executor is None:
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+# Fetch one page of a user's changesets, optionally limited to a time window.
+# With time=start,end the API returns changesets closed after start and created
+# before end, newest first. With raw=True the page is the unparsed response body.
+async def fetch_page(client, user_id, start=None, end=None, raw=False):
+    url = f"{API_URL}/changesets?user={user_id}"
+    if start is not None:
+        url += f"&time={start.strftime(TIME_FORMAT)},{end.strftime(TIME_FORMAT)}"
+    return await (client.get_body(url) if raw else client.get_changesets(url))
+
+def _created_at(cs):
+    return datetime.strptime(cs.created_at, TIME_FORMAT)
+
+# What paging needs to know about a page, parsed or raw:
+# (number of changesets, creation time of the oldest one or None)
+def _page_info(page):
+    if isinstance(page, bytes):
+        created = CREATED_AT.findall(page)
+        return len(created), datetime.strptime(min(created).decode(), TIME_FORMAT) if created else None
+    return len(page), min(_created_at(cs) for cs in page) if page else None
+
+# Fetch everything in [start, end), splitting into concurrent sub-windows when a page is full
+async def _fetch_window(client, user_id, start, end, pages, raw):
+    page = await fetch_page(client, user_id, start, end, raw)
+    pages.append(page)
+    count, oldest = _page_info(page)
+    if count < PAGE_SIZE:
+        return
+
+    # The page holds the newest PAGE_SIZE changesets; the rest are older than its oldest one
+    end = oldest + timedelta(seconds=1)
+    if end - start <= timedelta(seconds=2):
+        return  # Can't narrow the window any further
+    await _fetch_windows(client, user_id, start, end, pages, raw)
+
+# Split [start, end) into WINDOW_SPLIT windows and fetch them concurrently
+async def _fetch_windows(client, user_id, start, end, pages, raw):
+    step = (end - start) / WINDOW_SPLIT
+    windows = []
+    for i in range(WINDOW_SPLIT):
+        window_start = start + step * i - timedelta(seconds=1)  # Overlap so nothing falls between windows
+        window_end = end if i == WINDOW_SPLIT - 1 else start + step * (i + 1)
+        windows.append(_fetch_window(client, user_id, max(window_start, start), window_end, pages, raw))
+    await asyncio.gather(*windows)
+
+# Fetch the pages of a user's full changeset history, or with since only of
+# the changesets closed (or still open) after that time.
+# The first request returns the newest page; if the user has more than that,
+# the remaining history is fetched as concurrent time windows, which overlap
+# slightly (pages can repeat a changeset). With raw=True the pages are the
+# unparsed response bodies, for parsing elsewhere (see grab.stats_from_pages).
+# Returns [] for users without changesets and raises ApiError if any request
+# fails for good, so an incomplete history is never mistaken for a real one.
+async def fetch_pages(client, user_id, since=None, raw=False):
+    if since is None:
+        page = await fetch_page(client, user_id, raw=raw)
+    else:
+        page = await fetch_page(client, user_id, since, datetime.utcnow() + timedelta(days=1), raw)
+    count, oldest = _page_info(page)
+    if count == 0:
+        return []
+    pages = [page]
+    if count == PAGE_SIZE:
+        await _fetch_windows(client, user_id, since or HISTORY_START, oldest + timedelta(seconds=1), pages, raw)
+    return pages
+
+# A user's changesets (see fetch_pages), newest first without repeats
+async def fetch_changesets(client, user_id, since=None):
+    changesets = {cs.id: cs for page in await fetch_pages(client, user_id, since) for cs in page}
+    return sorted(changesets.values(), key=lambda cs: cs.id, reverse=True)
+
+# Fetch every changeset (from all users) closed after start and created before end.
+# The global feed is paged newest first by moving the end of the window back
+# to the oldest changeset of each full page.
+async def fetch_recent_changesets(client, start, end):
+    changesets = {}
+    while True:
+        url = f"{API_URL}/changesets?time={start.strftime(TIME_FORMAT)},{end.strftime(TIME_FORMAT)}"
+        page = await client.get_changesets(url)
+        for cs in page:
+            changesets[cs.id] = cs
+        if len(page) < PAGE_SIZE:
+            break
+        oldest = min(_created_at(cs) for cs in page)
+        # Step back a second if a whole page shares one timestamp, so paging always moves
+        end = oldest + timedelta(seconds=1) if oldest + timedelta(seconds=1) < end else end - timedelta(seconds=1)
+        if end <= start:
+            break
+    return list(changesets.values())
+
+# IDs of users with changesets created or closed between start and end
+async def fetch_active_user_ids(client, start, end):
+    changesets = await fetch_recent_changesets(client, start, end)
+    return sorted({cs.uid for cs in changesets if cs.uid})
+
+# Look up a user's ID from their display name through their changesets
+async def find_user_id(client, display_name):
+    page = await client.get_changesets(f"{API_URL}/changesets?display_name={quote(display_name.strip())}")
+    return page[0].uid if page else None
+
+# Fold the changesets closed since a state's last fetch into it (the full
+# history for a new state). Returns the number of changesets that changed it.
+async def refresh_state(client, state):
+    since = datetime.strptime(state["fetched_until"], stats.TIME_FORMAT) if state["fetched_until"] else None
+    fetched_at = datetime.utcnow()
+    changesets = await fetch_changesets(client, state["user_id"], since)
+    state["fetched_until"] = fetched_at.strftime(stats.TIME_FORMAT)
+    return stats.fold(state, changesets)
+
+# Bring a user's aggregate state up to date.
+# Users saved with a state only fetch the changesets closed since their last
+# fetch and fold them in; everyone else gets their full history fetched.
+# Returns (state, number of changesets that changed it).
+async def refresh_user(client, conn, user_id):
+    saved_state = store.load_state(conn, user_id)
+    state = stats.state_from_json(saved_state) if saved_state else stats.new_state(user_id)
+    return state, await refresh_state(client, state)
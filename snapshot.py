@@ -0,0 +1,351 @@
+import os
+import sys
+import mmap
+import time
+import json
+import struct
+import bisect
+import threading
+import store
+import activity
+
+# Read-only binary snapshot of the users table, published by the crawler.
+# App workers memory-map the same file, so the records are shared between
+# processes through the page cache instead of being loaded by every worker.
+# Layout (little-endian), every section starting on an 8-byte boundary:
+#   header       HEADER
+#   records      one RECORD per user, in user ID order
+#   id index     int32 per ID from min_id to min_id + id_span - 1: record number, or -1
+#   name order   uint32 record numbers sorted by username key (for username lookups)
+#   strings      uint32 offsets (count + 1) into UTF-8 data: usernames, keys, dates, editors, sources
+#   activity     per-day series (see activity.py): changesets array, then changes array
+# A new snapshot is written next to the old one and renamed over it, so
+# readers always see a complete file and pick up the new one on their next check.
+
+SNAPSHOT_PATH = os.path.join(store.DATA_FOLDER, "snapshot.bin")
+
+MAGIC = b"OGFSNAP1"
+HEADER = struct.Struct("<8sQIIII6Q")  # magic, store version, count, min_id, id_span, strings, section offsets
+RECORD = struct.Struct("<I2I2I2IQQ2I2IQdQ7I24IiQI")
+NO_STRING = 0xFFFFFFFF
+
+# Seconds between checks for a newly published snapshot
+CHECK_INTERVAL = 1.0
+
+def _align(buffer):
+    buffer.extend(bytes(-len(buffer) % 8))
+    return len(buffer)
+
+# Write a snapshot of every user in the database and publish it atomically
+def publish(conn, path=SNAPSHOT_PATH):
+    strings = {}
+    string_list = []
+
+    def string_id(value):
+        if value is None:
+            return NO_STRING
+        value = str(value)
+        index = strings.get(value)
+        if index is None:
+            index = strings[value] = len(string_list)
+            string_list.append(value)
+        return index
+
+    # The version is read first: a batch saved in between is then both in the
+    # snapshot and newer than it, and readers just load those users from the store
+    version = store.current_version(conn)
+    rows = conn.execute("SELECT user_id, username, username_key, first_edit, last_edit, total_edit_days,"
+                        " active_edit_days_30, total_changes, last_30_days_changes, most_used_editor,"
+                        " most_used_source, changeset_count, changesets_with_comments, last_changeset_id,"
+                        " updated_at, version, weekday_edits, hourly_edits, activity_start,"
+                        " activity_changesets, activity_changes FROM users ORDER BY user_id").fetchall()
+
+    records = bytearray()
+    series = bytearray()
+    user_ids = []
+    keys = []
+    for row in rows:
+        (user_id, username, key, first_edit, last_edit, total_edit_days, active_edit_days_30, total_changes,
+         last_30_days_changes, editor, source, changeset_count, changesets_with_comments, last_changeset_id,
+         updated_at, row_version, weekday_edits, hourly_edits, activity_start, day_changesets, day_changes) = row
+        series_offset, series_days = len(series), 0
+        if activity_start is not None:
+            series_days = len(day_changesets) // 4
+            series.extend(day_changesets)
+            series.extend(day_changes)
+        records.extend(RECORD.pack(
+            user_id, string_id(username), string_id(key), string_id(first_edit), string_id(last_edit),
+            total_edit_days or 0, active_edit_days_30 or 0, total_changes or 0, last_30_days_changes or 0,
+            string_id(editor), string_id(source), changeset_count or 0, changesets_with_comments or 0,
+            last_changeset_id or 0, updated_at or 0.0, row_version,
+            *json.loads(weekday_edits), *json.loads(hourly_edits),
+            activity_start or 0, series_offset, series_days,
+        ))
+        user_ids.append(user_id)
+        keys.append(key or "")
+
+    min_id = user_ids[0] if user_ids else 0
+    id_span = user_ids[-1] - min_id + 1 if user_ids else 0
+    id_index = [-1] * id_span
+    for number, user_id in enumerate(user_ids):
+        id_index[user_id - min_id] = number
+    name_order = sorted(range(len(keys)), key=keys.__getitem__)
+
+    encoded = [value.encode() for value in string_list]
+    string_offsets = [0]
+    for value in encoded:
+        string_offsets.append(string_offsets[-1] + len(value))
+
+    data = bytearray(bytes(HEADER.size))
+    offsets = []
+    for section in (records, struct.pack(f"<{id_span}i", *id_index),
+                    struct.pack(f"<{len(name_order)}I", *name_order),
+                    struct.pack(f"<{len(string_offsets)}I", *string_offsets), b"".join(encoded), series):
+        offsets.append(_align(data))
+        data.extend(section)
+    data[:HEADER.size] = HEADER.pack(MAGIC, version, len(user_ids), min_id, id_span, len(string_list), *offsets)
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"  # Only the host with the stats database publishes
+    with open(temp_path, "wb") as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)  # Readers see either the old file or the new one, never half of one
+    return len(user_ids)
+
+# One mapped snapshot file. Records are decoded straight from the mapping.
+class Snapshot:
+    def __init__(self, path=SNAPSHOT_PATH):
+        with open(path, "rb") as file:
+            self.stat = os.fstat(file.fileno())
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, self.version, self.count, self.min_id, self.id_span, string_count,
+         self.records_at, id_index_at, name_order_at, string_offsets_at, strings_at, self.series_at) = \
+            HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a stats snapshot")
+        if sys.byteorder != "little":
+            raise ValueError("Snapshots are read through native memoryview casts and need a little-endian host")
+        view = memoryview(self.map)
+        self.id_index = view[id_index_at:id_index_at + 4 * self.id_span].cast("i")
+        self.name_order = view[name_order_at:name_order_at + 4 * self.count].cast("I")
+        self.string_offsets = view[string_offsets_at:string_offsets_at + 4 * (string_count + 1)].cast("I")
+        self.strings_at = strings_at
+        self.view = view
+
+    def _string(self, index):
+        if index == NO_STRING:
+            return None
+        start = self.strings_at + self.string_offsets[index]
+        end = self.strings_at + self.string_offsets[index + 1]
+        return str(self.view[start:end], "utf-8")
+
+    def _unpack(self, number):
+        return RECORD.unpack_from(self.map, self.records_at + number * RECORD.size)
+
+    # Record number of a user ID, or None if the snapshot doesn't have them
+    def find(self, user_id):
+        slot = user_id - self.min_id
+        if not 0 <= slot < self.id_span:
+            return None
+        number = self.id_index[slot]
+        return number if number >= 0 else None
+
+    # User ID for a username (case-insensitive), by binary search over the name order
+    def find_username(self, username):
+        key = store.username_key(username)
+        if not key:
+            return None
+        names = _NameKeys(self)
+        i = bisect.bisect_left(names, key)
+        if i < len(names) and names[i] == key:
+            return self._unpack(self.name_order[i])[0]
+        return None
+
+    # Usernames starting with a prefix (case-insensitive), as (username, user_id)
+    # pairs in key order: a binary search to the first match, then a short scan.
+    # Users in skip are passed over.
+    def suggest(self, prefix, limit=10, skip=()):
+        key = store.username_key(prefix)
+        if not key:
+            return []
+        names = _NameKeys(self)
+        matches = []
+        i = bisect.bisect_left(names, key)
+        while i < len(names) and len(matches) < limit and names[i].startswith(key):
+            values = self._unpack(self.name_order[i])
+            if values[0] not in skip:
+                matches.append((self._string(values[1]), values[0]))
+            i += 1
+        return matches
+
+    # A user's record with the column names used by index.html (plus "Activity"), or None
+    def load_user(self, user_id):
+        number = self.find(user_id)
+        if number is None:
+            return None
+        values = self._unpack(number)
+        string = self._string
+        activity_start, series_offset, series_days = values[-3:]
+        series = None
+        if activity_start:
+            start = self.series_at + series_offset
+            middle = start + 4 * series_days
+            series = activity.DaySeries(activity_start, self.view[start:middle], self.view[middle:middle + 4 * series_days])
+        return {
+            "User ID": values[0],
+            "Username": string(values[1]),
+            "First Edit": string(values[3]),
+            "Last Edit": string(values[4]),
+            "Total Edit Days": values[5],
+            "Active Edit Days (Last 30 Days)": values[6],
+            "Total Changes": values[7],
+            "Changes (Last 30 Days)": values[8],
+            "Most Used Editor": string(values[9]),
+            "Most Used Source": string(values[10]),
+            "Total Changesets": values[11],
+            "Changesets with Comments": values[12],
+            "Edits Per Weekday": dict(enumerate(values[16:23])),
+            "Edits Per Hour": dict(enumerate(values[23:47])),
+            "Last Changeset ID": values[13],
+            "Updated At": values[14],
+            "Version": values[15],
+            "Activity": series,
+        }
+
+# Sequence view of the username keys in name order, for bisect
+class _NameKeys:
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def __len__(self):
+        return self.snapshot.count
+
+    def __getitem__(self, i):
+        snapshot = self.snapshot
+        return snapshot._string(snapshot._unpack(snapshot.name_order[i])[2]) or ""
+
+# The app's handle on the published snapshot.
+# current() notices a newly published file (at most once per CHECK_INTERVAL)
+# and swaps to it; the old mapping is released once no request uses it.
+# Users the store has rewritten since the snapshot was taken are tracked
+# through the store's write version and served from the database instead.
+class SnapshotReader:
+    def __init__(self, path=SNAPSHOT_PATH):
+        self.path = path
+        self.snapshot = None
+        self.checked = 0.0
+        self.newer = set()  # Users written to the store after the snapshot
+        self.seen_version = 0
+        self.lock = threading.Lock()
+
+    def current(self):
+        now = time.monotonic()
+        if now - self.checked >= CHECK_INTERVAL:
+            with self.lock:
+                if now - self.checked >= CHECK_INTERVAL:
+                    self.checked = now
+                    self._reopen_if_changed()
+        return self.snapshot
+
+    def _reopen_if_changed(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self.snapshot = None
+            return
+        old = self.snapshot
+        if old is not None and (stat.st_ino, stat.st_mtime_ns) == (old.stat.st_ino, old.stat.st_mtime_ns):
+            return
+        try:
+            snapshot = Snapshot(self.path)
+        except (OSError, ValueError, struct.error) as e:
+            print(f"? Could not open snapshot {self.path}: {e!r}")
+            return
+        self.newer, self.seen_version = set(), snapshot.version
+        self.snapshot = snapshot
+
+    # Catch up with users written since the snapshot (cheap when nothing changed)
+    def _sync(self, conn, snapshot):
+        version = store.current_version(conn)
+        if version == self.seen_version:
+            return
+        with self.lock:
+            if snapshot is not self.snapshot or version <= self.seen_version:
+                return
+            rows = conn.execute("SELECT user_id FROM users WHERE version > ?", (self.seen_version,))
+            self.newer.update(user_id for (user_id,) in rows)
+            self.seen_version = version
+
+    # A user's record from the snapshot, or None to fall back to the database
+    def load_user(self, conn, user_id):
+        snapshot = self.current()
+        if snapshot is None:
+            return None
+        self._sync(conn, snapshot)
+        if user_id in self.newer:
+            return None
+        return snapshot.load_user(user_id)
+
+    # Records for several users with one catch-up check, as {user_id: record};
+    # users missing from the snapshot or newer than it are left out
+    def load_users(self, conn, user_ids):
+        snapshot = self.current()
+        if snapshot is None:
+            return {}
+        self._sync(conn, snapshot)
+        records = {}
+        for user_id in user_ids:
+            if user_id not in self.newer:
+                record = snapshot.load_user(user_id)
+                if record is not None:
+                    records[user_id] = record
+        return records
+
+    # User IDs for several usernames with one catch-up check, as {username: user_id};
+    # names the snapshot can't answer for are left out
+    def find_usernames(self, conn, usernames):
+        snapshot = self.current()
+        if snapshot is None:
+            return {}
+        self._sync(conn, snapshot)
+        found = {}
+        for username in usernames:
+            user_id = snapshot.find_username(username)
+            if user_id is not None and user_id not in self.newer:
+                found[username] = user_id
+        return found
+
+    # User ID for a username from the snapshot, or None to fall back to the database
+    def find_username(self, conn, username):
+        snapshot = self.current()
+        if snapshot is None:
+            return None
+        self._sync(conn, snapshot)
+        user_id = snapshot.find_username(username)
+        return None if user_id in self.newer else user_id
+
+    # Username suggestions from the snapshot, with users newer than it read from
+    # the database's username index instead; None if there is no snapshot.
+    # The database is only asked when users changed since the snapshot: its own
+    # first matches then include every newer user who belongs in the result.
+    def suggest(self, conn, prefix, limit=10):
+        snapshot = self.current()
+        if snapshot is None:
+            return None
+        self._sync(conn, snapshot)
+        newer = self.newer
+        matches = snapshot.suggest(prefix, limit, skip=newer)
+        if newer:
+            matches += [(username, user_id) for username, user_id in store.suggest_usernames(conn, prefix, limit)
+                        if user_id in newer]
+            matches.sort(key=lambda match: (store.username_key(match[0] or ""), match[1]))
+        return matches[:limit]
+
+# Run script
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else SNAPSHOT_PATH
+    started = time.perf_counter()
+    count = publish(store.connect(), path)
+    print(f"? Published {count} users to {path} in {time.perf_counter() - started:.1f} s")
@@ -0,0 +1,153 @@
+import json
+from collections import namedtuple
+from datetime import datetime, date
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+# The "last 30 days" figures cover today and the days before it, this many days in all
+RECENT_DAYS = 30
+
+# Histories at least this long are aggregated with NumPy (see columnar.py)
+COLUMNAR_THRESHOLD = 256
+
+# Compact changeset record; created_at is kept as the API's timestamp string
+Changeset = namedtuple("Changeset", ["id", "created_at", "changes_count", "comments_count",
+                                     "created_by", "source", "user", "uid", "open"])
+
+# Per-user aggregate state.
+# Everything in it can be merged: edit days (with their change counts),
+# editor/source counters and weekday/hour histograms are all sums, so folding
+# new changesets into a stored state gives the same result as recomputing
+# from the full history. Changesets that are still open are kept aside and
+# only folded in once they close, since their counts can still change.
+def new_state(user_id):
+    return {
+        "user_id": user_id,
+        "username": None,
+        "last_changeset_id": 0,  # Highest changeset ID seen (folded or open)
+        "fetched_until": None,  # Time of the last fetch, for "closed after" queries
+        "day_changes": {},  # Day ordinal -> changes made that day; the keys are the edit days
+        "day_changesets": {},  # Day ordinal -> changesets created that day
+        "editor_usage": {},
+        "source_usage": {},
+        "weekday_edits": [0] * 7,  # 0 = Monday, 6 = Sunday
+        "hourly_edits": [0] * 24,  # 0-23 UTC hours
+        "total_changes": 0,
+        "changeset_count": 0,
+        "changesets_with_comments": 0,
+        "open": {},  # Changeset ID -> Changeset, not folded yet
+    }
+
+# Add one changeset's contribution to a state
+def _add(state, cs):
+    created_at = datetime.strptime(cs.created_at, TIME_FORMAT)
+    day = created_at.toordinal()
+    state["day_changes"][day] = state["day_changes"].get(day, 0) + cs.changes_count
+    state["day_changesets"][day] = state["day_changesets"].get(day, 0) + 1
+    state["total_changes"] += cs.changes_count
+    state["changeset_count"] += 1
+    state["weekday_edits"][created_at.weekday()] += 1
+    state["hourly_edits"][created_at.hour] += 1
+    if cs.comments_count > 0:
+        state["changesets_with_comments"] += 1
+    if cs.created_by is not None:
+        state["editor_usage"][cs.created_by] = state["editor_usage"].get(cs.created_by, 0) + 1
+    if cs.source is not None:
+        state["source_usage"][cs.source] = state["source_usage"].get(cs.source, 0) + 1
+
+# Fold changesets into a state. Changesets that were already folded are
+# skipped, so passing overlapping or repeated fetches is safe.
+# Returns the number of changesets that changed the state.
+def fold(state, changesets):
+    changed = 0
+    for cs in sorted(changesets, key=lambda cs: cs.id):
+        already_folded = cs.id <= state["last_changeset_id"] and cs.id not in state["open"]
+        if already_folded:
+            continue
+        if cs.id >= state["last_changeset_id"] and cs.user:
+            state["username"] = cs.user  # The newest changeset has the current username
+        state["last_changeset_id"] = max(state["last_changeset_id"], cs.id)
+        if cs.open:
+            state["open"][cs.id] = cs  # Replaces an older copy of the same open changeset
+        else:
+            state["open"].pop(cs.id, None)
+            _add(state, cs)
+        changed += 1
+    return changed
+
+def _most_used(usage):
+    if not usage:
+        return "Unknown"
+    return max(usage.items(), key=lambda item: (item[1], item[0]))[0]
+
+# Compute the stats the crawlers save from a state.
+# Open changesets are included, and the 30-day figures are taken relative to today.
+def to_stats(state, today=None):
+    if state["open"]:
+        merged = {key: (dict(value) if isinstance(value, dict) else list(value) if isinstance(value, list) else value)
+                  for key, value in state.items()}
+        for cs in state["open"].values():
+            _add(merged, cs)
+        state = merged
+    if not state["day_changes"]:
+        return None  # No edits
+
+    today = today or datetime.utcnow().date()
+    cutoff = today.toordinal() - RECENT_DAYS + 1
+    recent_days = [day for day in state["day_changes"] if day >= cutoff]
+    return {
+        "user_id": state["user_id"],
+        "username": state["username"],
+        "first_edit": date.fromordinal(min(state["day_changes"])),
+        "last_edit": date.fromordinal(max(state["day_changes"])),
+        "total_edit_days": len(state["day_changes"]),
+        "active_edit_days_30": len(recent_days),
+        "total_changes": state["total_changes"],
+        "last_30_days_changes": sum(state["day_changes"][day] for day in recent_days),
+        "most_used_editor": _most_used(state["editor_usage"]),
+        "most_used_source": _most_used(state["source_usage"]),
+        "changeset_count": state["changeset_count"],
+        "changesets_with_comments": state["changesets_with_comments"],
+        "weekday_edits": dict(enumerate(state["weekday_edits"])),
+        "hourly_edits": dict(enumerate(state["hourly_edits"])),
+        "last_changeset_id": state["last_changeset_id"],
+        "day_changesets": state["day_changesets"],  # Per-day series, packed by the store (see activity.py)
+        "day_changes": state["day_changes"],
+    }
+
+# Stats ready for store.save_users, carrying the serialised state along
+def stats_for_store(state, today=None):
+    user_stats = to_stats(state, today)
+    if user_stats is not None:
+        user_stats["state"] = state_to_json(state)
+    return user_stats
+
+# Compute stats from a full history in one go
+def compute_stats(user_id, changesets, fetched_until=None, today=None):
+    if len(changesets) >= COLUMNAR_THRESHOLD:
+        try:
+            import columnar
+        except ImportError:
+            pass  # NumPy isn't installed, fold one changeset at a time
+        else:
+            return columnar.compute_stats(user_id, changesets, fetched_until, today)
+    state = new_state(user_id)
+    state["fetched_until"] = fetched_until
+    fold(state, changesets)
+    return stats_for_store(state, today)
+
+# Serialise a state for the store (JSON has no integer keys or tuples)
+def state_to_json(state):
+    data = dict(state)
+    data["day_changes"] = sorted(state["day_changes"].items())
+    data["day_changesets"] = sorted(state["day_changesets"].items())
+    data["open"] = [list(cs) for cs in state["open"].values()]
+    return json.dumps(data, separators=(",", ":"))
+
+def state_from_json(text):
+    data = json.loads(text)
+    data["day_changes"] = {day: changes for day, changes in data["day_changes"]}
+    # States saved before per-day changeset counts existed start without them
+    data["day_changesets"] = {day: count for day, count in data.get("day_changesets", [])}
+    data["open"] = {cs[0]: Changeset(*cs) for cs in data["open"]}
+    return data
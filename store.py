@@ -0,0 +1,343 @@
+import os
+import csv
+import sys
+import json
+import time
+import sqlite3
+import activity
+
+# Define storage folder and database file
+DATA_FOLDER = "data"
+DB_PATH = os.path.join(DATA_FOLDER, "stats.db")
+
+# Stat keys used by the crawlers, paired with the column names shown in the app
+FIELDS = [
+    ("user_id", "User ID"),
+    ("username", "Username"),
+    ("first_edit", "First Edit"),
+    ("last_edit", "Last Edit"),
+    ("total_edit_days", "Total Edit Days"),
+    ("active_edit_days_30", "Active Edit Days (Last 30 Days)"),
+    ("total_changes", "Total Changes"),
+    ("last_30_days_changes", "Changes (Last 30 Days)"),
+    ("most_used_editor", "Most Used Editor"),
+    ("most_used_source", "Most Used Source"),
+    ("changeset_count", "Total Changesets"),
+    ("changesets_with_comments", "Changesets with Comments"),
+    ("weekday_edits", "Edits Per Weekday"),
+    ("hourly_edits", "Edits Per Hour"),
+    ("last_changeset_id", "Last Changeset ID"),
+    ("updated_at", "Updated At"),
+    ("version", "Version"),
+]
+HISTOGRAM_SIZES = {"weekday_edits": 7, "hourly_edits": 24}
+
+# Stats users can be ranked by; each has its own index, so a top-N query
+# reads N index entries instead of scanning the table
+LEADERBOARD_METRICS = ["total_changes", "last_30_days_changes", "active_edit_days_30", "changeset_count"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    username_key TEXT,
+    first_edit TEXT,
+    last_edit TEXT,
+    total_edit_days INTEGER,
+    active_edit_days_30 INTEGER,
+    total_changes INTEGER,
+    last_30_days_changes INTEGER,
+    most_used_editor TEXT,
+    most_used_source TEXT,
+    changeset_count INTEGER,
+    changesets_with_comments INTEGER,
+    weekday_edits TEXT,
+    hourly_edits TEXT,
+    last_changeset_id INTEGER,
+    version INTEGER NOT NULL,
+    state TEXT,
+    updated_at REAL,
+    activity_start INTEGER,
+    activity_changesets BLOB,
+    activity_changes BLOB
+);
+CREATE INDEX IF NOT EXISTS users_username_key ON users (username_key);
+CREATE INDEX IF NOT EXISTS users_version ON users (version);
+""" + "".join(f"CREATE INDEX IF NOT EXISTS users_top_{metric} ON users ({metric} DESC, user_id);\n"
+              for metric in LEADERBOARD_METRICS) + """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Open the stats database, creating the tables on first use.
+# wal=False keeps a rollback journal instead, for files on a network filesystem
+# (WAL needs shared memory between the processes using the file).
+def connect(path=DB_PATH, wal=True):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute(f"PRAGMA journal_mode={'WAL' if wal else 'DELETE'}")  # With WAL, readers (the app) don't block the crawler
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    _add_missing_columns(conn)
+    return conn
+
+# Open a database that connect() has already set up, for reading only.
+# Skips the schema checks, which cost more than the lookups the app makes.
+def connect_reader(path=DB_PATH):
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute("PRAGMA query_only=ON")
+    return conn
+
+# Columns added after the first release of the users table
+ADDED_COLUMNS = [("state", "TEXT"), ("updated_at", "REAL"), ("activity_start", "INTEGER"),
+                 ("activity_changesets", "BLOB"), ("activity_changes", "BLOB")]
+
+def _add_missing_columns(conn):
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(users)")}
+    for name, column_type in ADDED_COLUMNS:
+        if name not in existing:
+            conn.execute(f"ALTER TABLE users ADD COLUMN {name} {column_type}")
+
+# Normalise a username the same way for writing and looking up
+def username_key(username):
+    return str(username).strip().casefold()
+
+# Decode a histogram written as text: "{0: 5, 1: 3}" (CSV files) or "[5, 3]" (JSON)
+def _parse_histogram(text):
+    text = text.strip()
+    if text.startswith("["):
+        return json.loads(text)
+    histogram = {}
+    for item in text.strip("{}").split(","):
+        if item.strip():
+            slot, count = item.split(":")
+            histogram[int(slot)] = int(count)
+    return histogram
+
+# Turn a {slot: count} dictionary (or list) into a fixed-size list of counts
+def histogram_to_list(histogram, size):
+    if isinstance(histogram, str):
+        histogram = _parse_histogram(histogram)
+    if isinstance(histogram, (list, tuple)):
+        counts = [int(n) for n in histogram][:size]
+        return counts + [0] * (size - len(counts))
+    counts = [0] * size
+    for slot, count in (histogram or {}).items():
+        if 0 <= int(slot) < size:
+            counts[int(slot)] = int(count)
+    return counts
+
+def get_meta(conn, key, default=None):
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+
+def set_meta(conn, key, value):
+    conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+# Current write version; it goes up by one with every saved batch
+def current_version(conn):
+    return int(get_meta(conn, "version", 0))
+
+# Take the next write version inside the caller's transaction. The version is
+# bumped before it is read, so the transaction already holds the database's
+# write lock and concurrent writers (shard workers, the app's live fetcher)
+# never share a version: readers that sync on "version > seen" miss nothing.
+def _next_version(conn):
+    conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('version', '0')")
+    conn.execute("UPDATE meta SET value = CAST(value AS INTEGER) + 1 WHERE key = 'version'")
+    return current_version(conn)
+
+USER_COLUMNS = ["user_id", "username", "username_key", "first_edit", "last_edit", "total_edit_days",
+                "active_edit_days_30", "total_changes", "last_30_days_changes", "most_used_editor",
+                "most_used_source", "changeset_count", "changesets_with_comments", "weekday_edits", "hourly_edits",
+                "last_changeset_id", "version", "state", "updated_at", "activity_start", "activity_changesets",
+                "activity_changes"]
+
+INSERT_USER = (f"INSERT OR REPLACE INTO users ({', '.join(USER_COLUMNS)})"
+               f" VALUES ({', '.join('?' * len(USER_COLUMNS))})")
+
+# Save a batch of user stats in a single transaction
+def save_users(conn, stats_list):
+    with conn:  # Commits on success, rolls back the whole batch on error
+        return write_users(conn, stats_list)
+
+# Convert one user's stats into an INSERT_USER row; raises on malformed values
+def _user_row(user_stats, version, updated_at):
+    # Per-day series (see activity.py); users imported from CSV files have none
+    series = activity.pack(user_stats.get("day_changesets"), user_stats.get("day_changes")) or (None, None, None)
+    return (
+        int(user_stats["user_id"]),
+        user_stats["username"],
+        username_key(user_stats["username"]) if user_stats["username"] else None,
+        str(user_stats["first_edit"]),
+        str(user_stats["last_edit"]),
+        int(user_stats["total_edit_days"]),
+        int(user_stats["active_edit_days_30"]),
+        int(user_stats["total_changes"]),
+        int(user_stats["last_30_days_changes"]),
+        user_stats["most_used_editor"],
+        user_stats["most_used_source"],
+        int(user_stats["changeset_count"]),
+        int(user_stats["changesets_with_comments"]),
+        json.dumps(histogram_to_list(user_stats["weekday_edits"], 7)),
+        json.dumps(histogram_to_list(user_stats["hourly_edits"], 24)),
+        int(user_stats.get("last_changeset_id") or 0),
+        version,
+        user_stats.get("state"),  # Serialised aggregate state (see stats.py)
+        updated_at,
+        *series,
+    )
+
+# Write a batch of user stats inside the caller's transaction
+def write_users(conn, stats_list):
+    stats_list = [user_stats for user_stats in stats_list if user_stats]
+    if not stats_list:
+        return 0
+    version = _next_version(conn)
+    updated_at = time.time()
+    rows = [_user_row(user_stats, version, updated_at) for user_stats in stats_list]
+    conn.executemany(INSERT_USER, rows)
+    return len(rows)
+
+def save_user(conn, user_stats):
+    return save_users(conn, [user_stats])
+
+# Copy the users of another stats database (e.g. a shard worker's result
+# store) into this one, in one transaction under a single new version.
+# Users this database saved more recently than the other one are kept.
+def merge_users(conn, path):
+    conn.execute("ATTACH DATABASE ? AS other", (path,))
+    try:
+        with conn:
+            version = _next_version(conn)
+            values = ", ".join("?" if column == "version" else f"o.{column}" for column in USER_COLUMNS)
+            cursor = conn.execute(f"INSERT OR REPLACE INTO users ({', '.join(USER_COLUMNS)}) SELECT {values}"
+                                  " FROM other.users o WHERE NOT EXISTS (SELECT 1 FROM users u"
+                                  " WHERE u.user_id = o.user_id AND u.updated_at > o.updated_at)", (version,))
+        return cursor.rowcount
+    finally:
+        conn.execute("DETACH DATABASE other")
+
+# Convert a database row (selected with SELECT_USERS) into a dictionary keyed by the crawler's stat names
+def _row_to_stats(row):
+    stats = {}
+    for (key, _), value in zip(FIELDS, row):
+        if key in HISTOGRAM_SIZES:
+            value = dict(enumerate(json.loads(value)))
+        stats[key] = value
+    return stats
+
+SELECT_USERS = "SELECT " + ", ".join(key for key, _ in FIELDS) + " FROM users"
+
+# Load one user's stats with the crawler's key names, or None if unknown
+def load_stats(conn, user_id):
+    row = conn.execute(SELECT_USERS + " WHERE user_id = ?", (int(user_id),)).fetchone()
+    return _row_to_stats(row) if row else None
+
+# Load one user's serialised aggregate state (None for users saved without one)
+def load_state(conn, user_id):
+    row = conn.execute("SELECT state FROM users WHERE user_id = ?", (int(user_id),)).fetchone()
+    return row[0] if row else None
+
+# Load one user's per-day activity as an activity.DaySeries, or None if it has none
+def load_activity(conn, user_id):
+    row = conn.execute("SELECT activity_start, activity_changesets, activity_changes FROM users WHERE user_id = ?",
+                       (int(user_id),)).fetchone()
+    if row is None or row[0] is None:
+        return None
+    return activity.DaySeries(*row)
+
+# Load one user's record with the column names used by the index.html template
+def load_user(conn, user_id):
+    stats = load_stats(conn, user_id)
+    if stats is None:
+        return None
+    return {label: stats[key] for key, label in FIELDS}
+
+# Most user IDs bound in a single "IN (...)" query (older SQLite builds allow 999 variables)
+MAX_QUERY_IDS = 900
+
+SELECT_USERS_WITH_ACTIVITY = ("SELECT " + ", ".join(key for key, _ in FIELDS)
+                              + ", activity_start, activity_changesets, activity_changes FROM users")
+
+# Load many users' records at once (as load_user, plus their activity under
+# "Activity"), reading each chunk of IDs with one query. Returns {user_id: record};
+# unknown users are left out.
+def load_users(conn, user_ids):
+    user_ids = list(dict.fromkeys(int(user_id) for user_id in user_ids))
+    records = {}
+    for start in range(0, len(user_ids), MAX_QUERY_IDS):
+        chunk = user_ids[start:start + MAX_QUERY_IDS]
+        rows = conn.execute(SELECT_USERS_WITH_ACTIVITY + f" WHERE user_id IN ({', '.join('?' * len(chunk))})", chunk)
+        for row in rows:
+            stats = _row_to_stats(row[:len(FIELDS)])
+            record = {label: stats[key] for key, label in FIELDS}
+            record["Activity"] = activity.DaySeries(*row[len(FIELDS):]) if row[len(FIELDS)] is not None else None
+            records[record["User ID"]] = record
+    return records
+
+# User IDs for usernames (case-insensitive) through the username index, as
+# {username: user_id} (None if unknown); for a name held by several users
+# (after renames) the most recently saved one wins
+def find_user_ids(conn, usernames):
+    keys = {username: username_key(username) for username in usernames}
+    unique_keys = list(set(keys.values()))
+    found = {}
+    for start in range(0, len(unique_keys), MAX_QUERY_IDS):
+        chunk = unique_keys[start:start + MAX_QUERY_IDS]
+        found.update(conn.execute(f"SELECT username_key, user_id FROM users"
+                                  f" WHERE username_key IN ({', '.join('?' * len(chunk))}) ORDER BY version", chunk))
+    return {username: found.get(key) for username, key in keys.items()}
+
+# Usernames starting with a prefix (case-insensitive) through the username
+# index, as (username, user_id) pairs in key order
+def suggest_usernames(conn, prefix, limit=10):
+    key = username_key(prefix)
+    if not key:
+        return []
+    return conn.execute("SELECT username, user_id FROM users WHERE username_key >= ? AND username_key < ?"
+                        " ORDER BY username_key, user_id LIMIT ?", (key, key + "\U0010ffff", int(limit))).fetchall()
+
+# Top users by one of LEADERBOARD_METRICS, as (user_id, username, value) rows, best first
+def top_users(conn, metric, limit=10, offset=0):
+    if metric not in LEADERBOARD_METRICS:
+        raise ValueError(f"Unknown leaderboard metric: {metric}")
+    return conn.execute(f"SELECT user_id, username, {metric} FROM users"
+                        f" ORDER BY {metric} DESC, user_id LIMIT ? OFFSET ?", (int(limit), int(offset))).fetchall()
+
+# Import an existing folder of per-user CSV files into the database
+def migrate_csv_folder(conn, folder=DATA_FOLDER, batch_size=1000):
+    labels = {label: key for key, label in FIELDS}
+    batch = []
+    imported = 0
+    for file in sorted(os.listdir(folder)):
+        if not file.endswith(".csv"):
+            continue
+        try:
+            with open(os.path.join(folder, file), "r", encoding="utf-8") as csvfile:
+                row = next(csv.DictReader(csvfile), None)
+            if row is None:
+                continue
+            # Files from grab.py use the display names, grabtest2.py used the raw stat keys
+            user_stats = {labels.get(column, column): value for column, value in row.items()}
+            user_stats.setdefault("last_changeset_id", 0)
+            _user_row(user_stats, 0, 0)  # Check the values now, so one bad file can't fail the whole batch
+            batch.append(user_stats)
+        except Exception as e:
+            print(f"Error reading {file}: {e}")
+        if len(batch) >= batch_size:
+            imported += save_users(conn, batch)
+            batch = []
+    imported += save_users(conn, batch)
+    return imported
+
+# Run script
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["migrate"]:
+        folder = sys.argv[2] if len(sys.argv) > 2 else DATA_FOLDER
+        conn = connect()
+        print(f"? Imported {migrate_csv_folder(conn, folder)} users from {folder} into {DB_PATH}")
+    else:
+        print("Usage: python store.py migrate [csv_folder]")
@@ -0,0 +1,144 @@
+import os
+import sys
+import json
+import random
+from datetime import datetime, timedelta
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import stats
+import activity
+from stats import Changeset
+
+USER_ID = 4242
+EDITORS = ["iD 2.27.0", "JOSM/1.5", "Level0 v1.2", None]
+SOURCES = ["survey", "imagination", None]
+
+# A user's history as the API would return it once every changeset is closed:
+# increasing IDs and times over about two years, renamed halfway through
+def make_history(count, seed=1):
+    rng = random.Random(seed)
+    created = datetime(2022, 7, 1)
+    changeset_id = 1000
+    history = []
+    for i in range(count):
+        created += timedelta(minutes=rng.randint(1, 2500))
+        changeset_id += rng.randint(1, 50)  # Other users' changesets fall in between
+        history.append(Changeset(
+            id=changeset_id,
+            created_at=created.strftime(stats.TIME_FORMAT),
+            changes_count=rng.randint(0, 400),
+            comments_count=rng.choice([0, 0, 1, 3]),
+            created_by=rng.choice(EDITORS),
+            source=rng.choice(SOURCES),
+            user="old name" if i < count // 2 else "new name",
+            uid=USER_ID,
+            open=False,
+        ))
+    return history
+
+# How the history looks while its newest changesets are still open
+def with_open_tail(changesets, open_count):
+    return [cs._replace(open=True, changes_count=cs.changes_count // 2) if i >= len(changesets) - open_count else cs
+            for i, cs in enumerate(changesets)]
+
+# Fetches as an incremental crawler makes them: each one returns the
+# changesets up to a cut-off, overlapping the previous fetch, with the newest
+# few still open (they come back closed in a later fetch)
+def make_fetches(history, cuts, overlap=5, open_count=3):
+    fetches = []
+    start = 0
+    for cut in cuts:
+        fetches.append(with_open_tail(history[max(start - overlap - open_count, 0):cut], open_count))
+        start = cut
+    fetches.append(history[max(start - overlap - open_count, 0):])
+    return fetches
+
+# A "today" a few days after the last changeset, so the 30-day figures aren't empty
+def today_after(changesets):
+    return datetime.strptime(changesets[-1].created_at, stats.TIME_FORMAT).date() + timedelta(days=5)
+
+def full_run(changesets, today):
+    state = stats.new_state(USER_ID)
+    stats.fold(state, changesets)
+    return stats.stats_for_store(state, today)
+
+# Stats with the saved state parsed, so states serialised with different
+# key or open-changeset order compare equal
+def comparable(user_stats):
+    user_stats = dict(user_stats)
+    state = json.loads(user_stats.pop("state"))
+    state["open"] = sorted(state["open"])
+    user_stats["state"] = state
+    return user_stats
+
+@pytest.mark.parametrize("cuts", [[100], [50, 51, 200, 390], list(range(20, 400, 37))])
+def test_incremental_folds_match_full_run(cuts):
+    history = make_history(400)
+    state = stats.new_state(USER_ID)
+    for fetch in make_fetches(history, cuts):
+        stats.fold(state, fetch)
+        # Every run starts from the state the previous one saved
+        state = stats.state_from_json(stats.state_to_json(state))
+    assert not state["open"]
+    today = today_after(history)
+    expected = full_run(history, today)
+    assert expected["last_30_days_changes"] > 0
+    assert comparable(stats.stats_for_store(state, today)) == comparable(expected)
+
+def test_repeated_fetches_change_nothing():
+    history = make_history(120)
+    state = stats.new_state(USER_ID)
+    stats.fold(state, history)
+    saved = stats.state_to_json(state)
+    assert stats.fold(state, history[40:]) == 0
+    assert stats.state_to_json(state) == saved
+
+def test_open_changesets_count_until_closed():
+    history = make_history(60)
+    fetched = with_open_tail(history, 4)
+    state = stats.new_state(USER_ID)
+    stats.fold(state, fetched)
+    assert len(state["open"]) == 4
+    assert state["changeset_count"] == 56  # Open changesets stay out of the state...
+    today = today_after(history)
+    user_stats = stats.to_stats(state, today)
+    assert user_stats["changeset_count"] == 60  # ...but are in the stats
+    assert user_stats["total_changes"] == sum(cs.changes_count for cs in fetched)
+
+    assert stats.fold(state, history[-4:]) == 4
+    assert not state["open"]
+    assert comparable(stats.stats_for_store(state, today)) == comparable(full_run(history, today))
+
+def test_json_round_trip():
+    state = stats.new_state(USER_ID)
+    stats.fold(state, with_open_tail(make_history(80), 2))
+    restored = stats.state_from_json(stats.state_to_json(state))
+    assert restored == state
+
+@pytest.mark.parametrize("open_count", [0, 5])
+def test_columnar_matches_fold(open_count):
+    columnar = pytest.importorskip("columnar")
+    history = with_open_tail(make_history(stats.COLUMNAR_THRESHOLD * 2, seed=7), open_count)
+    today = today_after(history)
+    expected = full_run(history, today)
+    assert comparable(columnar.compute_stats(USER_ID, history, today=today)) == comparable(expected)
+    # compute_stats picks the columnar path for long histories
+    assert comparable(stats.compute_stats(USER_ID, history, today=today)) == comparable(expected)
+
+# "Last 30 days" means today and the 29 days before it, at crawl time and in the app
+def test_last_30_days_boundary():
+    columnar = pytest.importorskip("columnar")
+    today = datetime(2024, 6, 30).date()
+    def on(days_ago, changes):
+        created = datetime(2024, 6, 30, 12) - timedelta(days=days_ago)
+        return Changeset(id=5000 - days_ago, created_at=created.strftime(stats.TIME_FORMAT), changes_count=changes,
+                         comments_count=0, created_by=None, source=None, user="name", uid=USER_ID, open=False)
+    history = [on(30, 1000), on(29, 10), on(0, 1)]
+    for user_stats in (full_run(history, today), columnar.compute_stats(USER_ID, history, today=today)):
+        assert (user_stats["last_30_days_changes"], user_stats["active_edit_days_30"]) == (11, 2)
+        series = activity.DaySeries(*activity.pack(user_stats["day_changesets"], user_stats["day_changes"]))
+        last_30_days = series.last_days(stats.RECENT_DAYS, today)
+        assert (last_30_days["changes"], last_30_days["active_days"]) == (11, 2)
+        assert (last_30_days["end"] - last_30_days["start"]).days == stats.RECENT_DAYS - 1
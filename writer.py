@@ -0,0 +1,114 @@
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import store
+import journal
+import metrics
+
+# Users written per transaction
+BATCH_SIZE = 100
+
+# Finished users allowed to queue up before the crawler has to wait
+MAX_PENDING = 1000
+
+# Longest a finished user waits before its batch is written (seconds)
+FLUSH_INTERVAL = 2.0
+
+RECORDS_WRITTEN = metrics.counter("ogf_records_written_total", "User records saved by the crawler")
+WRITE_FAILURES = metrics.counter("ogf_write_failures_total", "User records in batches that could not be saved")
+BATCH_SECONDS = metrics.histogram("ogf_write_batch_seconds", "Time to write one batch of users")
+QUEUE_DEPTH = metrics.gauge("ogf_writer_queue_depth", "Finished users waiting for the writer")
+
+# Writer stage for crawler output.
+# Workers hand finished users to put(); a background task groups them into
+# batches and writes each batch (stats and journal entries together) in one
+# transaction on a dedicated thread, so the event loop never blocks on disk.
+# When the writer falls behind, put() waits, which slows the crawl down to
+# what the disk can take. Use as "async with StatsWriter() as writer".
+class StatsWriter:
+    def __init__(self, db_path=store.DB_PATH, batch_size=BATCH_SIZE, max_pending=MAX_PENDING,
+                 flush_interval=FLUSH_INTERVAL, use_journal=True, wal=True):
+        self.db_path = db_path
+        self.wal = wal
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.use_journal = use_journal
+        self.queue = asyncio.Queue(maxsize=max_pending)
+        self.thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix="stats-writer")
+        self.conn = None  # Opened on the writer thread, sqlite connections stay on one thread
+        self.task = None
+        self.written = 0
+        self.failed = 0  # Users in batches that could not be saved
+
+    async def __aenter__(self):
+        self.task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.queue.put(None)  # Stop marker, everything queued before it still gets written
+        await self.task
+        await asyncio.get_running_loop().run_in_executor(self.thread, self._close)
+        self.thread.shutdown()
+
+    # Queue one finished user: its stats (or None) and, with the journal, its outcome
+    async def put(self, user_id, user_stats, error=None):
+        await self.queue.put((user_id, user_stats, error))
+        QUEUE_DEPTH.set(self.queue.qsize())
+
+    async def _next_batch(self):
+        item = await self.queue.get()
+        if item is None:
+            return None, True
+        batch = [item]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        done = False
+        while not done:
+            batch, done = await self._next_batch()
+            QUEUE_DEPTH.set(self.queue.qsize())
+            if not batch:
+                continue
+            try:
+                await loop.run_in_executor(self.thread, self._write, batch)
+            except Exception as e:
+                self.failed += len(batch)
+                WRITE_FAILURES.inc(len(batch))
+                # Nothing from this batch reached the journal, so a resumed crawl checks these users again
+                print(f"? Failed to save a batch of {len(batch)} users: {e!r}")
+
+    # Runs on the writer thread
+    def _write(self, batch):
+        started = time.perf_counter()
+        if self.conn is None:
+            self.conn = store.connect(self.db_path, self.wal)
+            if self.use_journal:
+                journal.init(self.conn)
+        stats_list = [user_stats for _, user_stats, _ in batch if user_stats]
+        with self.conn:  # Stats and journal entries commit (or roll back) together
+            store.write_users(self.conn, stats_list)
+            if self.use_journal:
+                journal.write_entries(self.conn, [(user_id, journal.outcome_of(user_stats, error), error)
+                                                  for user_id, user_stats, error in batch])
+        self.written += len(stats_list)
+        RECORDS_WRITTEN.inc(len(stats_list))
+        BATCH_SECONDS.observe(time.perf_counter() - started)
+        print(f"? Saved {len(stats_list)} users ({len(batch)} checked, {self.written} saved so far)")
+
+    def _close(self):
+        if self.conn is not None:
+            self.conn.close()